@@ -3,11 +3,14 @@
 # copyright notices and license terms.
 import datetime as mdatetime
 from datetime import datetime, timedelta
-from StringIO import StringIO
 from collections import defaultdict
+from decimal import Decimal
+from itertools import islice, product
 import logging
+import multiprocessing
 import os
-from sql import Null
+from sql import Null, Table, Column, Literal
+from sql.functions import CurrentTimestamp
 from sql.operators import Or
 import subprocess
 import tempfile
@@ -27,10 +30,16 @@ from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 from trytond.tools import grouped_slice
 from trytond.config import config
+from trytond.filestore import filestore
 from trytond import backend
 from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
 
-from .babi_eval import babi_eval
+from .babi_eval import attribute_paths, related_field, Prefetcher, \
+    RowEvaluator, UnsupportedExpression
+from .babi_sql import ExpressionCompiler, NotCompilable, translate_filter
+from .babi_aggregate import HashAggregator
+from .babi_sketch import new_sketch
+from .babi_snapshot import dumps, loads
 
 
 __all__ = ['Filter', 'Expression', 'Report', 'ReportGroup', 'Dimension',
@@ -57,7 +66,11 @@ AGGREGATE_TYPES = [
     ('count', 'Count'),
     ('max', 'Max'),
     ('min', 'Min'),
+    ('distinct', 'Approximate Distinct Count'),
+    ('median', 'Approximate Median'),
     ]
+# Aggregates computed with the mergeable sketches of babi_sketch
+SKETCH_AGGREGATES = ('distinct', 'median')
 
 SRC_CHARS = u""" .'"()/*-+?¿!&$[]{}@#`'^:;<>=~%,|\\"""
 DST_CHARS = u"""__________________________________"""
@@ -258,12 +271,18 @@ def create_columns(name, ffields):
             columns[field_name] = fields.Many2One(field['related_model'],
                 fname, ondelete='SET NULL')
 
+        if field.get('aggregate') in SKETCH_AGGREGATES:
+            # Raw values on the base records and the sketch on the groups
+            columns['%s__sketch' % field_name] = fields.Text(fname)
+
     columns['babi_group'] = fields.Char('Group', size=500)
+    # Indexes are created by ReportExecution.create_indexes once the table is
+    # loaded
     columns['parent'] = fields.Many2One(name, 'Parent', ondelete='CASCADE',
-        select=True, left='parent_left', right='parent_right')
+        left='parent_left', right='parent_right')
     columns['children'] = fields.One2Many(name, 'parent', 'Children')
-    columns['parent_left'] = fields.Integer('Parent Left', select=True)
-    columns['parent_right'] = fields.Integer('Parent Right', select=True)
+    columns['parent_left'] = fields.Integer('Parent Left')
+    columns['parent_right'] = fields.Integer('Parent Right')
     return columns
 
 
@@ -320,6 +339,74 @@ def create_groups_access(model, groups):
         ModelAccess.create(to_create)
 
 
+# Number of rows saved by each COPY
+COPY_ROWS = 2000
+
+
+def copy_value(value):
+    "Returns value encoded for the text format of COPY"
+    # Empty strings are stored as NULL
+    if value is None or value == '':
+        return '\\N'
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    value = (value.replace('\\', '\\\\').replace('\t', '\\t')
+        .replace('\n', '\\n').replace('\r', '\\r'))
+    return value.encode('utf-8')
+
+
+def insert_value(value):
+    "Returns value as a parameter of INSERT, with the same rules as COPY"
+    if value is None or value == '':
+        return None
+    if not isinstance(value, (basestring, int, long, float, Decimal,
+                mdatetime.date)):
+        value = unicode(value)
+    return value
+
+
+def measure_value(ttype, value):
+    """
+    Returns value converted to the python type of the column of a measure of
+    type ttype, like it would be read from the table
+    """
+    if value is None or value == '':
+        return None
+    if ttype == 'int':
+        return int(value)
+    elif ttype == 'float':
+        return float(value)
+    elif ttype == 'numeric':
+        if isinstance(value, Decimal):
+            return value
+        return Decimal(unicode(value))
+    return value
+
+
+class CopyReader(object):
+    """
+    File-like object that feeds COPY with rows
+
+    Rows are encoded when the reader is created because encoding a value may
+    read records and no other query can be executed on the connection while
+    COPY is running.
+    """
+    def __init__(self, rows):
+        self._data = ''.join('\t'.join([copy_value(x) for x in row]) + '\n'
+            for row in rows)
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        if size < 0:
+            self._position = len(self._data)
+        else:
+            self._position = min(start + size, len(self._data))
+        return self._data[start:self._position]
+
+
 class TimeoutException(Exception):
     pass
 
@@ -336,32 +423,56 @@ class TimeoutChecker:
             self._callback()
 
 
-class DimensionIterator:
-    def __init__(self, values):
-        """
-        values should be a dictionary where its values are
-        non-empty lists.
-        """
-        self.values = values
-        self.keys = sorted(values.keys())
-        self.keys.reverse()
-        self.current = dict.fromkeys(values.keys(), 0)
-        self.current[self.keys[0]] = -1
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        for x in xrange(len(self.keys)):
-            key = self.keys[x]
-            if self.current[key] >= len(self.values[key]) - 1:
-                if x == len(self.keys) - 1:
-                    raise StopIteration
-                self.current[key] = 0
-            else:
-                self.current[key] += 1
-                break
-        return self.current
+# References to the database objects inherited by worker processes. They
+# must be kept alive as closing their connections would close the ones of the
+# parent process.
+_parent_databases = {}
+
+
+def init_worker():
+    "Prepares a worker process to open its own database connections"
+    Database = backend.get('Database')
+    _parent_databases.update(Database._databases)
+    Database._databases.clear()
+
+
+def create_data_range(args):
+    "Evaluates the records of a range of ids in a new transaction"
+    execution_id, domain, min_id, max_id, staging, template, source = args
+    with Transaction().new_transaction() as transaction:
+        Execution = Pool().get('babi.report.execution')
+        execution = Execution(execution_id)
+        execution.create_staging_data(domain, min_id, max_id, staging,
+            template, source)
+        transaction.commit()
+
+
+def tree_bounds(rows):
+    """
+    Returns the parent_left and parent_right of each node of a tree
+
+    rows is a list of (id, parent) tuples. Children are numbered in the order
+    of rows and roots start at left 1, like ModelSQL._rebuild_tree does.
+    Returns a list of (id, left, right) tuples.
+    """
+    children = defaultdict(list)
+    for id_, parent in rows:
+        children[parent].append(id_)
+    bounds = []
+    lefts = {}
+    counter = 0
+    # Iterative depth first walk to support deep trees
+    stack = [(x, False) for x in reversed(children[None])]
+    while stack:
+        id_, visited = stack.pop()
+        counter += 1
+        if visited:
+            bounds.append((id_, lefts.pop(id_), counter))
+            continue
+        lefts[id_] = counter
+        stack.append((id_, True))
+        stack.extend((x, False) for x in reversed(children[id_]))
+    return bounds
 
 
 class Filter(ModelSQL, ModelView):
@@ -597,6 +708,28 @@ class Report(ModelSQL, ModelView):
         'Last Executions', readonly=True), 'get_last_execution')
     crons = fields.One2Many('ir.cron', 'babi_report', 'Schedulers',
         context={'babi_report': Eval('id')})
+    workers = fields.Integer('Workers', help='Number of processes used to '
+        'evaluate the records. If empty, the value of the configuration is '
+        'used.')
+    engine = fields.Selection([
+            ('database', 'Database'),
+            ('memory', 'Memory'),
+            ], 'Engine', required=True, help='With "Memory" records are '
+        'aggregated while they are evaluated and only the aggregated rows '
+        'are saved. It is faster but needs memory for all the groups and '
+        'evaluates the records in a single process. Not used on reports '
+        'with dimensions on columns.')
+    incremental = fields.Boolean('Incremental', help='Only evaluate the '
+        'records created, modified or deleted since the last calculated '
+        'execution. Changes on related records are not detected. Not used '
+        'on reports with dimensions on columns.')
+    dictionary_encoding = fields.Boolean('Dictionary Encoding',
+        help='Store integer codes instead of the values of the char '
+        'dimensions while the records are evaluated and aggregated, and '
+        'replace them by their values at the end. Only used when the records '
+        'are evaluated in a single process by the "Database" engine, on '
+        'reports that are not incremental and have no dimensions on '
+        'columns.')
 
     @classmethod
     def __setup__(cls):
@@ -623,6 +756,10 @@ class Report(ModelSQL, ModelView):
         config = Config(1)
         return config.default_timeout
 
+    @staticmethod
+    def default_engine():
+        return 'database'
+
     @depends('model')
     def on_change_with_model_name(self, name=None):
         return self.model.model if self.model else None
@@ -840,7 +977,13 @@ class Report(ModelSQL, ModelView):
         """This method is intended to be called from ir.cron"""
         if not args:
             args = []
+        pool = Pool()
+        Execution = pool.get('babi.report.execution')
         reports = cls.search([('id', '=', args)])
+        Execution.check_truncated(Execution.search([
+                    ('report', 'in', [r.id for r in reports]),
+                    ('state', '=', 'calculated'),
+                    ]))
         return cls.calculate(reports)
 
     @classmethod
@@ -887,6 +1030,7 @@ class ReportExecution(ModelSQL, ModelView):
             ('timeout', 'Timeout'),
             ('failed', 'Failed'),
             ('canceled', 'Canceled'),
+            ('archived', 'Archived'),
             ], 'State', required=True, readonly=True)
     timeout = fields.Integer('Timeout', required=True, readonly=True,
         help='If report calculation should take more than the specified '
@@ -899,6 +1043,10 @@ class ReportExecution(ModelSQL, ModelView):
     internal_measures = fields.One2Many('babi.internal.measure',
         'execution', 'Internal Measures', readonly=True)
     pid = fields.Integer('Pid', readonly=True)
+    log = fields.Text('Log', readonly=True)
+    snapshot = fields.Char('Snapshot', readonly=True,
+        help='Identifier in the file store of the snapshot of the data of the '
+        'execution.')
 
     @classmethod
     def __setup__(cls):
@@ -912,10 +1060,17 @@ class ReportExecution(ModelSQL, ModelView):
                     'one is needed.'),
                 'no_measures': ('Execution "%s" has no measures. At least one '
                     'is needed.'),
+                'sketch_columns': ('Execution "%s" has dimensions on columns '
+                    'and approximate measures, which can not be used '
+                    'together.'),
+                'too_many_columns': ('Execution "%(execution)s" would need '
+                    '%(columns)s columns but the maximum is %(max)s. Set a '
+                    'limit on its column dimensions.'),
                 })
         cls._buttons.update({
                 'open': {
-                    'invisible': Eval('state') != 'calculated',
+                    'invisible': Not(In(Eval('state'),
+                            ['calculated', 'archived'])),
                     },
                 'cancel': {
                     'invisible': ((Eval('state') != 'in_progress') &
@@ -992,14 +1147,20 @@ class ReportExecution(ModelSQL, ModelView):
     @classmethod
     def delete(cls, executions):
         cls.remove_data(executions)
+        cls.remove_snapshots(executions)
         cls.remove_keywords(executions)
         to_delete = set([e.internal_name for e in executions])
         super(ReportExecution, cls).delete(executions)
+        cls.unregister_models(to_delete)
+
+    @staticmethod
+    def unregister_models(names):
+        "Removes the classes of the models names from the pool"
         # We should remove the classes from the pool so when removing realted
         # records it doesn't fail checking unexisting models
         pool = Pool()
         with pool.lock:
-            for name in to_delete:
+            for name in names:
                 try:
                     del pool._pool[pool.database_name]['model'][name]
                 except KeyError:
@@ -1011,23 +1172,65 @@ class ReportExecution(ModelSQL, ModelView):
         pool = Pool()
         Keyword = pool.get('ir.action.keyword')
 
-        models = ['%s,-1' % e.babi_model.model for e in executions]
+        models = ['%s,-1' % e.babi_model.model for e in executions
+            if e.babi_model]
         keywords = Keyword.search([('model', 'in', models)])
         Keyword.delete(keywords)
 
     @classmethod
-    def clean(cls, date=None):
+    def clean(cls, date=None, archive=None):
         pool = Pool()
         Date = pool.get('ir.date')
+        Config = pool.get('babi.configuration')
         if date is None:
             days = config.getint('babi', 'retention_days', default=30)
             date = Date.today() - timedelta(days=days)
+        if archive is None:
+            archive = Config(1).archive_executions
 
         date = datetime.combine(date, mdatetime.time.min)
         executions = cls.search([('date', '<', date)])
+        if archive:
+            cls.archive([e for e in executions if e.state == 'calculated'])
+            executions = [e for e in executions
+                if e.state not in ('calculated', 'archived')]
         cls.delete(executions)
         return True
 
+    @classmethod
+    def archive(cls, executions):
+        """
+        Saves the data of executions as snapshots and removes their tables,
+        models and keywords until they are opened again
+        """
+        pool = Pool()
+        Model = pool.get('ir.model')
+        if not executions:
+            return
+        cls.save_snapshots(executions)
+        # Executions without table nor snapshot have no data to archive
+        executions = [e for e in executions if e.snapshot]
+        if not executions:
+            return
+        cls.remove_keywords(executions)
+        models = [e.babi_model for e in executions if e.babi_model]
+        cls.write(executions, {
+                'state': 'archived',
+                'babi_model': None,
+                })
+        Model.delete(models)
+        cls.unregister_models([e.internal_name for e in executions])
+
+    def unarchive(self):
+        "Restores the data of the archived execution from its snapshot"
+        transaction = Transaction()
+        self.restore_snapshot()
+        with transaction.set_context(_datetime=self.date):
+            with transaction.set_user(0):
+                self.create_keywords()
+        self.state = 'calculated'
+        self.save()
+
     @classmethod
     def remove_data(cls, executions):
         TableHandler = backend.get('TableHandler')
@@ -1037,6 +1240,12 @@ class ReportExecution(ModelSQL, ModelView):
         for sub_executions in grouped_slice(executions, 200):
             cursor = transaction.connection.cursor()
             for execution in sub_executions:
+                dictionary = execution.get_dictionary_table()
+                if TableHandler.table_exist(dictionary):
+                    # Left by a failed calculation
+                    cursor.execute('DROP TABLE %s' % dictionary)
+                for staging in execution.get_staging_tables():
+                    cursor.execute('DROP TABLE %s' % staging)
                 table = execution.internal_name
                 if not TableHandler.table_exist(table):
                     continue
@@ -1051,6 +1260,17 @@ class ReportExecution(ModelSQL, ModelView):
                 except:
                     pass
             transaction.commit()
+        cls.remove_detail(executions)
+
+    @classmethod
+    def remove_detail(cls, executions):
+        "Removes the detail tables of incremental executions"
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        for execution in executions:
+            table = execution.get_detail_table()
+            if TableHandler.table_exist(table):
+                cursor.execute('DROP TABLE %s' % table)
 
     def validate_model(self, with_columns=False):
         "makes model available on Tryton and pool instance"
@@ -1064,11 +1284,64 @@ class ReportExecution(ModelSQL, ModelView):
         if not self.babi_model:
             self.babi_model = model
             self.save()
+            if self.unlogged_tables():
+                cursor = Transaction().connection.cursor()
+                cursor.execute('ALTER TABLE %s SET UNLOGGED'
+                    % self.internal_name)
 
         create_groups_access(model, self.report.groups)
         # Commit transaction to avoid locks
         Transaction().commit()
 
+    @staticmethod
+    def unlogged_tables():
+        "Returns if the tables of the executions must be created unlogged"
+        Config = Pool().get('babi.configuration')
+        # SET UNLOGGED is only available since PostgreSQL 9.5
+        return (Config(1).unlogged and backend.name() == 'postgresql'
+            and getattr(Transaction().connection, 'server_version', 0)
+            >= 90500)
+
+    @classmethod
+    def check_truncated(cls, executions):
+        """
+        Marks as pending the calculated executions whose unlogged table was
+        emptied by the crash recovery of the database and returns them.
+
+        Executions are marked in a new transaction so it is kept even if the
+        current one is rolled back.
+        """
+        if backend.name() != 'postgresql':
+            return []
+        executions = [e for e in executions if e.state == 'calculated']
+        if not executions:
+            return []
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT relname FROM pg_class WHERE '
+            'relpersistence = %s AND relname IN (' + ','.join(
+                ['%s'] * len(executions)) + ')',
+            ['u'] + [e.internal_name for e in executions])
+        unlogged = set(x for x, in cursor.fetchall())
+        truncated = []
+        for execution in executions:
+            if execution.internal_name not in unlogged:
+                continue
+            # A calculated execution has at least the root row
+            cursor.execute('SELECT 1 FROM %s LIMIT 1'
+                % execution.internal_name)
+            if cursor.fetchone():
+                continue
+            logging.getLogger(cls.__name__).warning('Table of execution %s '
+                'was truncated by crash recovery' % execution.rec_name)
+            truncated.append(execution)
+        if truncated:
+            with Transaction().new_transaction() as transaction:
+                to_write = cls.browse([e.id for e in truncated])
+                cls.write(to_write, {'state': 'pending'})
+                cls.remove_detail(to_write)
+                transaction.commit()
+        return truncated
+
     def timeout_exception(self):
         raise TimeoutException
 
@@ -1115,10 +1388,197 @@ class ReportExecution(ModelSQL, ModelView):
                         exception=True)
                     execution.save()
                     raise
+        cls.snapshot_old(list(set(e.report for e in executions)))
+
+    @classmethod
+    def snapshot_old(cls, reports):
+        """
+        Archives the calculated executions of reports that are older than the
+        ones to keep in the database
+        """
+        Config = Pool().get('babi.configuration')
+        live_executions = Config(1).live_executions
+        if not live_executions:
+            return
+        for report in reports:
+            executions = cls.search([
+                    ('report', '=', report.id),
+                    ('state', '=', 'calculated'),
+                    ], order=[('date', 'DESC')], offset=live_executions)
+            cls.archive(executions)
+
+    @classmethod
+    def save_snapshots(cls, executions):
+        """
+        Saves the tables of executions in the file store and drops them with
+        their classes
+        """
+        TableHandler = backend.get('TableHandler')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        to_remove = []
+        for execution in executions:
+            table = execution.internal_name
+            if not TableHandler.table_exist(table):
+                continue
+            if not execution.snapshot:
+                cursor.execute('SELECT * FROM %s WHERE 1 = 0' % table)
+                names = ['create_date'] + [x[0] for x in cursor.description
+                    if x[0] != 'create_date']
+                execution.snapshot = filestore.set(
+                    dumps(names, cls.read_table(table, names)),
+                    prefix=transaction.database.name)
+                execution.save()
+                logging.getLogger(cls.__name__).info('Saved snapshot of '
+                    'execution %s' % execution.rec_name)
+            to_remove.append(execution)
+        cls.remove_data(to_remove)
+        cls.unregister_models([e.internal_name for e in to_remove])
+
+    @staticmethod
+    def read_table(table, names):
+        """
+        Yields the values of the columns names of the rows of table in
+        batches of COPY_ROWS rows, paginated on the id
+        """
+        cursor = Transaction().connection.cursor()
+        index = names.index('id')
+        columns = ','.join('"%s"' % x for x in names)
+        last_id = 0
+        while True:
+            cursor.execute('SELECT %s FROM %s WHERE id > %%s ORDER BY id '
+                'LIMIT %d' % (columns, table, COPY_ROWS), (last_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1][index]
+
+    @classmethod
+    def remove_snapshots(cls, executions):
+        "Removes the files of the snapshots of executions"
+        # Only the default file store saves files in the data directory
+        if not hasattr(filestore, '_filename'):
+            return
+        prefix = Transaction().database.name
+        snapshots = set(e.snapshot for e in executions if e.snapshot)
+        if not snapshots:
+            return
+        # Files are named by their content so they may be shared
+        others = cls.search([
+                ('snapshot', 'in', list(snapshots)),
+                ('id', 'not in', [e.id for e in executions]),
+                ])
+        snapshots -= set(e.snapshot for e in others)
+        for snapshot in snapshots:
+            filename = filestore._filename(snapshot, prefix)
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def restore_snapshot(self):
+        "Creates the table of the execution again from its snapshot"
+        pool = Pool()
+        transaction = Transaction()
+        names, rows = loads(filestore.get(self.snapshot,
+                prefix=transaction.database.name))
+        # validate_model commits the table, which is left empty if the
+        # restore fails afterwards
+        with transaction.set_context(_datetime=self.date):
+            self.validate_model()
+        table = pool.get(self.babi_model.model)._table
+        cursor = transaction.connection.cursor()
+        cursor.execute('DELETE FROM %s' % table)
+        cursor.execute('SELECT * FROM %s WHERE 1 = 0' % table)
+        existing = set(x[0] for x in cursor.description)
+        indexes = [i for i, x in enumerate(names) if x in existing]
+        # The original create_date of the rows is kept
+        self.insert_rows(table, [names[i] for i in indexes],
+            ([row[i] for i in indexes] for row in rows))
+        with transaction.set_context(_datetime=self.date):
+            self.create_indexes()
+        logging.getLogger(self.__name__).info('Restored snapshot of '
+            'execution %s' % self.rec_name)
+
+    def add_log(self, message):
+        "Adds message to the log of the execution"
+        logging.getLogger(self.__name__).info(message)
+        self.log = u'%s%s\n' % (self.log or u'', message)
+
+    def get_columns(self):
+        "Returns the names of the columns filled in by create_data"
+        columns = ['create_date', 'create_uid']
+        columns += [x.internal_name for x in self.report.dimensions]
+        columns += [x.internal_name for x in self.report.columns]
+        columns += [x.internal_name + ('__sketch'
+                if x.aggregate in SKETCH_AGGREGATES else '')
+            for x in self.internal_measures]
+        return columns
+
+    def get_encoded_columns(self):
+        """
+        Returns the positions in get_columns of the char dimensions whose
+        values are replaced by integer codes while the execution is calculated
+        """
+        report = self.report
+        # Worker processes could not share the codes
+        if (not report.dictionary_encoding or report.columns
+                or report.engine == 'memory' or report.incremental
+                or self.use_parallel()):
+            return []
+        return [i for i, x in enumerate(report.dimensions, 2)
+            if x.expression.ttype == 'char']
+
+    def get_dictionary_table(self):
+        "Returns the name of the table with the values of the codes"
+        return '%s_dict' % self.internal_name
+
+    def get_workers(self):
+        "Returns the number of processes used to evaluate the records"
+        Config = Pool().get('babi.configuration')
+        return self.report.workers or Config(1).workers or 1
+
+    def use_parallel(self):
+        "Returns if the records are evaluated by worker processes"
+        cursor = Transaction().connection.cursor()
+        # Temporary tables are not visible to the worker processes
+        return (self.get_workers() > 1 and not self.report.columns
+            and hasattr(cursor, 'copy_from'))
+
+    def get_expressions(self):
+        """
+        Returns a list with the name, the expression, the field type and the
+        value used for None of each column filled in by create_data
+        """
+        expressions = []
+        for dimension in self.report.dimensions + self.report.columns:
+            ttype = dimension.expression.ttype
+            expressions.append((dimension.name,
+                    dimension.expression.expression, ttype,
+                    '' if ttype == 'many2one' else 'empty'))
+        for measure in self.internal_measures:
+            if measure.aggregate in SKETCH_AGGREGATES:
+                # Stored as text in the sketch column
+                expressions.append((measure.name, measure.expression,
+                        'char', ''))
+            else:
+                expressions.append((measure.name, measure.expression,
+                        measure.ttype, 'zero'))
+        return expressions
+
+    def translate_python_filter(self):
+        """
+        Returns the domain translated from the python expression of the
+        filter, the AST node of the conditions that must be evaluated with
+        Python and the number of conditions
+        """
+        Model = Pool().get(self.report.model.model)
+        return translate_filter(Model, self.report.filter.python_expression)
 
     def get_python_filter(self):
+        "Returns the part of the python filter that is not in the domain"
         if self.report.filter and self.report.filter.python_expression:
-            return self.report.filter.python_expression
+            _, remainder, _ = self.translate_python_filter()
+            return remainder
 
     def create_keywords(self):
         pool = Pool()
@@ -1135,6 +1595,28 @@ class ReportExecution(ModelSQL, ModelView):
         keyword.groups = self.report.groups
         keyword.save()
 
+    @staticmethod
+    def search_records(Model, domain, limit):
+        """
+        Yields the records of Model matching domain in chunks of limit
+        records.
+
+        Chunks are paginated on the last id seen instead of using an offset,
+        so each search only reads its own chunk of the table.
+        """
+        last_id = None
+        while True:
+            chunk_domain = domain
+            if last_id is not None:
+                chunk_domain = [domain, ('id', '>', last_id)]
+            with Transaction().set_context(_datetime=None):
+                records = Model.search(chunk_domain, order=[('id', 'ASC')],
+                    limit=limit)
+            if not records:
+                break
+            yield records
+            last_id = records[-1].id
+
     def create_data(self):
         "Creates data for this execution"
         pool = Pool()
@@ -1154,6 +1636,9 @@ class ReportExecution(ModelSQL, ModelView):
             self.raise_user_error('no_measures', self.rec_name)
         if not self.report.dimensions:
             self.raise_user_error('no_dimensions', self.rec_name)
+        if self.report.columns and any(x.aggregate in SKETCH_AGGREGATES
+                for x in self.report.measures):
+            self.raise_user_error('sketch_columns', self.rec_name)
 
         domain = '[]'
         if self.report.filter and self.report.filter.domain:
@@ -1182,38 +1667,18 @@ class ReportExecution(ModelSQL, ModelView):
                 'false': False,
                 'true': True,
                 })
+        if self.report.filter and self.report.filter.python_expression:
+            filter_domain, _, conditions = self.translate_python_filter()
+            if filter_domain:
+                domain = [domain, filter_domain]
+            self.add_log(u'Python filter: %s of %s conditions translated '
+                'into the domain' % (len(filter_domain), conditions))
         start = datetime.today()
         self.update_internal_measures()
         with_columns = len(self.report.columns) > 0
         self.validate_model(with_columns=with_columns)
 
-        dimension_names = [x.internal_name for x in self.report.dimensions]
-        dimension_expressions = [(compile(x.expression.expression, '<string>',
-                    'eval'), '' if x.expression.ttype == 'many2one' else
-                'empty') for x in self.report.dimensions]
-        measure_names = [x.internal_name for x in
-            self.internal_measures]
-        measure_expressions = [compile(x.expression, '<string>', 'eval') for x
-            in self.internal_measures]
-        if self.report.columns:
-            dimension_names.extend([x.internal_name for x in
-                    self.report.columns])
-            dimension_expressions.extend([(compile(x.expression.expression,
-                            '<string>', 'eval'),
-                        '' if x.expression.ttype == 'many2one'
-                        else 'empty') for x in self.report.columns])
-
-        columns = (['create_date', 'create_uid'] + dimension_names +
-            measure_names)
-        columns = ['"%s"' % x for x in columns]
-        # Some older versions of psycopg do not allow column names
-        # to be of type unicode
-        columns = [str(x) for x in columns]
-
-        uid = transaction.user
-        python_filter = self.get_python_filter()
-        if python_filter:
-            python_filter = compile(python_filter, '<string>', 'eval')
+        columns = self.get_columns()
 
         table = BIModel._table
         if self.report.columns:
@@ -1222,83 +1687,36 @@ class ReportExecution(ModelSQL, ModelView):
             cursor.execute('CREATE TEMP TABLE %s AS SELECT * FROM %s WHERE '
                 ' 0 = 1' % (table, BIModel._table))
 
-        # Process records
-        offset = 2000
-        index = 0
-
-        def sanitanize(x):
-            if (isinstance(x, basestring) or isinstance(x, str)
-                    or isinstance(x, unicode)):
-                x = x.replace('|', '-')
-            if not isinstance(x, unicode):
-                return unicode(x)
-            else:
-                return unicode(x)
-
-        with transaction.set_context(_datetime=None):
-            records = Model.search(domain, offset=index * offset, limit=offset)
-        while records:
-            checker.check()
-            logger.info('Calculated %s,  %s records in %s seconds'
-                % (model, index * offset, datetime.today() - start))
+        previous = None
+        in_memory = (self.report.engine == 'memory'
+            and not self.report.columns)
+        if in_memory:
+            self.create_memory_data(Model, domain, table, checker)
+        elif (self.report.incremental and not self.report.columns
+                and not self.filtered):
+            previous = self.create_incremental_data(Model, domain, table,
+                checker)
+        else:
+            self.extract_data(Model, domain, table, checker)
 
-            to_create = ''
-            # var o it's used on expression!!
-            # Don't rename var
-            # chunk = records[index * offset:(index + 1) * offset]
-            for record in records:
-                if python_filter:
-                    if not babi_eval(python_filter, record,
-                            convert_none=False):
-                        continue
-                vals = ['now()', str(uid)]
-                vals += [sanitanize(babi_eval(x[0], record, convert_none=x[1]))
-                    for x in dimension_expressions]
-                vals += [sanitanize(babi_eval(x, record, convert_none='zero'))
-                    for x in measure_expressions]
-                record = u'|'.join(vals).replace('\n', ' ')
-                to_create += record.replace('\\', '').encode('utf-8') + '\n'
-
-            if to_create:
-                if hasattr(cursor, 'copy_from'):
-                    data = StringIO(to_create)
-                    cursor.copy_from(data, table, sep='|', null='',
-                        columns=columns)
-                else:
-                    base_query = 'INSERT INTO %s (' % table
-                    base_query += ','.join([unicode(x) for x in columns])
-                    base_query += ' ) VALUES '
-                    for line in to_create.split('\n'):
-                        if len(line) == 0:
-                            continue
-                        query = base_query + '(now(),'
-                        query += ','.join(["'%s'" % unicode(x)
-                                for x in line.split('|')[1:]])
-                        query += ')'
-                        cursor.execute(query)
-
-            index += 1
-            with transaction.set_context(_datetime=None):
-                records = Model.search(domain, offset=index * offset,
-                    limit=offset)
+        columns = ['"%s"' % x for x in columns]
+        # Some older versions of psycopg do not allow column names
+        # to be of type unicode
+        columns = [str(x) for x in columns]
 
         if self.report.columns:
-            distincts = self.distinct_dimension_columns(cursor, table)
-            self.update_internal_measures(distincts)
+            self.limit_dimension_columns(table)
+            combinations = self.distinct_dimension_columns(cursor, table)
+            self.check_columns(len(combinations))
+            pivot = self.update_internal_measures(combinations)
             self.validate_model()
-            query = 'INSERT INTO %s ('
-            query += ','.join([unicode(x) for x in columns])
-            query += ',' + ','.join([unicode(x.internal_name) for x in
-                    self.internal_measures])
-            query += ') SELECT '
-            query += ','.join([unicode(x) for x in columns])
-            query += ',' + ','.join([unicode(x.expression) for x in
-                    self.internal_measures])
-            query += ' FROM %s '
-            cursor.execute(query % (BIModel._table, table))
+            self.pivot_data(table, columns, pivot)
             cursor.execute('DROP TABLE %s ' % (table))
 
-        self.update_measures(checker)
+        if not in_memory:
+            self.update_measures(checker)
+            self.decode_dimensions(BIModel._table)
+        self.create_indexes()
 
         logger.info('Calc all %s records in %s seconds'
             % (model, datetime.today() - start))
@@ -1306,66 +1724,645 @@ class ReportExecution(ModelSQL, ModelView):
         self.state = 'calculated'
         self.duration = time.time() - update_start
         self.save()
+        if previous:
+            # The detail is only needed by the last calculated execution
+            self.remove_detail([previous])
         logger.info('End Update Data of report: %s' % self.rec_name)
 
-    def distinct_dimension_columns(self, cursor, tablename):
-        distincts = {}
+    def extract_data(self, Model, domain, table, checker, source=False):
+        """
+        Evaluates the expressions on the records of Model matching domain and
+        saves the result into table.
+
+        If source is True the id of each record is saved in the babi_source
+        column.
+        """
+        if self.create_sql_data(Model, domain, table, source):
+            pass
+        elif self.use_parallel():
+            self.create_parallel_data(Model, domain, table,
+                self.get_workers(), checker, source)
+        else:
+            self.create_python_data(self.search_records(Model, domain, 2000),
+                table, checker, source)
+
+    def create_memory_data(self, Model, domain, table, checker):
+        """
+        Aggregates the records of Model matching domain at every level of the
+        report in memory and only saves the aggregated rows into table
+        """
+        cursor = Transaction().connection.cursor()
+        dimensions = list(self.report.dimensions)
+        group_by = [x for x in dimensions if x.group_by]
+        extra = [x for x in dimensions if not x.group_by]
+        positions = [dimensions.index(x) for x in group_by + extra]
+        measures = self.internal_measures
+        aggregator = HashAggregator(len(group_by), len(extra),
+            [x.aggregate for x in measures])
+        chars = [x.expression.ttype == 'char' for x in group_by + extra]
+        ttypes = [None if x.aggregate in SKETCH_AGGREGATES else x.ttype
+            for x in measures]
+
+        for _, values in self.evaluate_records(
+                self.search_records(Model, domain, 2000), checker):
+            row = [values[i] for i in positions]
+            # Use the values that would be stored in the table
+            row = [unicode(v) if c and v not in (None, '') else v
+                for v, c in zip(row, chars)]
+            row += [measure_value(t, v)
+                for v, t in zip(values[len(dimensions):], ttypes)]
+            aggregator.add(row)
+        checker.check()
+
+        ids = self.reserve_ids(table, len(aggregator))
+        key_ids = {}
+        tree = []
+        groups = []
+        for (key, values), id_ in zip(aggregator.rows(sketches=True), ids):
+            key_ids[key] = id_
+            tree.append((id_, key_ids.get(aggregator.parent(key))))
+            groups.append((key, values))
+        bounds = dict((x[0], x[1:]) for x in tree_bounds(tree))
+
+        names = ['create_date', 'create_uid', 'id', 'parent', 'parent_left',
+            'parent_right', 'babi_group']
+        names += [x.internal_name for x in group_by + extra]
+        names += [x.internal_name for x in measures]
+        # Saved like update_sketches does for the database engine
+        names += ['%s__sketch' % x.internal_name for x in measures
+            if x.aggregate in SKETCH_AGGREGATES]
+        uid = Transaction().user
+
+        def rows():
+            for (id_, parent), (key, values) in zip(tree, groups):
+                level = min(len(key), len(group_by))
+                babi_group = None
+                if level:
+                    babi_group = group_by[level - 1].internal_name
+                key = list(key) + [None] * (len(positions) - len(key))
+                # TODO: Translate '(all)'
+                if not level and group_by[0].expression.ttype != 'many2one':
+                    key[0] = '(all)'
+                yield (['now()', uid, id_, parent] + list(bounds[id_])
+                    + [babi_group] + key + values)
+        self.insert_rows(table, names, rows())
+        self.add_log(u'Aggregated in memory into %s rows' % len(groups))
+
+    @staticmethod
+    def reserve_ids(table, count):
+        "Returns count new ids for the records of table"
+        cursor = Transaction().connection.cursor()
+        if hasattr(cursor, 'copy_from'):
+            cursor.execute("SELECT nextval('%s_id_seq') "
+                "FROM generate_series(1, %d)" % (table, count))
+            return [x[0] for x in cursor.fetchall()]
+        cursor.execute('SELECT MAX(id) FROM %s' % table)
+        last_id = cursor.fetchone()[0] or 0
+        return range(last_id + 1, last_id + count + 1)
+
+    def get_detail_table(self):
+        "Returns the name of the table with the values of each source record"
+        return '%s_detail' % self.internal_name
+
+    def get_signature(self):
+        "Returns the definition of the values stored in the detail table"
+        filter = self.report.filter
+        return (self.report.model.id, self.get_columns(),
+            [x[1:] for x in self.get_expressions()],
+            filter and filter.domain, filter and filter.python_expression)
+
+    def get_previous_execution(self):
+        """
+        Returns the last calculated execution whose detail table can be
+        reused by this one
+        """
+        TableHandler = backend.get('TableHandler')
+        executions = self.search([
+                ('report', '=', self.report.id),
+                ('state', '=', 'calculated'),
+                ('filtered', '=', False),
+                ('id', '!=', self.id),
+                ], order=[('date', 'DESC')], limit=1)
+        if not executions:
+            return
+        previous, = executions
+        if not TableHandler.table_exist(previous.get_detail_table()):
+            return
+        # Crash recovery empties the detail table with the execution table
+        if self.check_truncated([previous]):
+            return
+        with Transaction().set_context(_datetime=previous.create_date):
+            if (self.__class__(previous.id).get_signature()
+                    != self.get_signature()):
+                return
+        return previous
+
+    def create_incremental_data(self, Model, domain, table, checker):
+        """
+        Fills table from a detail table that keeps the values of each source
+        record.
+
+        The detail of the previous execution is copied so only the records
+        created or modified since it was calculated are evaluated. Returns the
+        previous execution used, if any.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        columns = ','.join(['"%s"' % x for x in self.get_columns()])
+        detail = self.get_detail_table()
+        cursor.execute('CREATE %s TABLE %s AS SELECT %s FROM %s WHERE 1 = 0'
+            % ('UNLOGGED' if self.unlogged_tables() else '', detail, columns,
+                table))
+        cursor.execute('ALTER TABLE %s ADD COLUMN babi_source INTEGER'
+            % detail)
+
+        previous = self.get_previous_execution()
+        if previous:
+            cursor.execute('INSERT INTO %s (%s, babi_source) '
+                'SELECT %s, babi_source FROM %s' % (detail, columns, columns,
+                    previous.get_detail_table()))
+            # Remove deleted records and the ones not matching the filter
+            with transaction.set_context(_datetime=None):
+                query, params = tuple(Model.search(domain, query=True))
+            # NOT IN would scan the ids for each row once they do not fit in
+            # memory, while NOT EXISTS is run as an anti-join
+            cursor.execute('DELETE FROM %s WHERE NOT EXISTS (SELECT 1 FROM '
+                '(%s) AS source WHERE source.id = %s.babi_source)'
+                % (detail, query, detail), params)
+            removed = cursor.rowcount
+            domain = [domain, ['OR',
+                    ('create_date', '>', previous.create_date),
+                    ('write_date', '>', previous.create_date),
+                    ]]
+            with transaction.set_context(_datetime=None):
+                query, params = tuple(Model.search(domain, query=True))
+            cursor.execute('DELETE FROM %s WHERE babi_source IN (%s)'
+                % (detail, query), params)
+            self.add_log(u'Incremental calculation from execution %s: %s '
+                'records removed, %s records updated' % (previous.rec_name,
+                    removed, cursor.rowcount))
+        else:
+            self.add_log(u'No previous execution to reuse, all records are '
+                'evaluated')
+
+        self.extract_data(Model, domain, detail, checker, source=True)
+        cursor.execute('CREATE INDEX %s_source_index ON %s (babi_source)'
+            % (detail, detail))
+        cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s'
+            % (table, columns, columns, detail))
+        return previous
+
+    def create_python_data(self, chunks, table, checker, source=False):
+        """
+        Evaluates the expressions on each chunk of records with a RowEvaluator
+        and saves the result into table
+        """
+        uid = Transaction().user
+        names = self.get_columns()
+        if source:
+            names.append('babi_source')
+        encoded = [] if source else self.get_encoded_columns()
+        codes = {}
+
+        def rows():
+            for record, values in self.evaluate_records(chunks, checker):
+                values = ['now()', uid] + values
+                for i in encoded:
+                    value = values[i]
+                    if value is None or value == '':
+                        continue
+                    # Use the value that would be stored in the table
+                    if isinstance(value, str):
+                        value = value.decode('utf-8')
+                    elif not isinstance(value, unicode):
+                        value = unicode(value)
+                    code = codes.get(value)
+                    if code is None:
+                        code = codes[value] = len(codes) + 1
+                    values[i] = code
+                if source:
+                    values.append(record.id)
+                yield values
+        self.insert_rows(table, names, rows())
+        if codes:
+            self.create_dictionary(codes)
+
+    def create_dictionary(self, codes):
+        """
+        Saves codes, a dictionary from each value to its code, into the
+        dictionary table used by decode_dimensions
+        """
+        cursor = Transaction().connection.cursor()
+        name = self.get_dictionary_table()
+        cursor.execute('CREATE %s TABLE %s (code VARCHAR, value VARCHAR)'
+            % ('UNLOGGED' if self.unlogged_tables() else '', name))
+        rows = [(str(c), v) for v, c in codes.iteritems()]
+        if hasattr(cursor, 'copy_from'):
+            cursor.copy_from(CopyReader(rows), name,
+                columns=['code', 'value'])
+        else:
+            dictionary = Table(name)
+            for sub_rows in grouped_slice(rows, 499):
+                cursor.execute(*dictionary.insert(
+                        [dictionary.code, dictionary.value], list(sub_rows)))
+
+    def decode_dimensions(self, table):
+        "Replaces the codes of the char dimensions of table by their values"
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        name = self.get_dictionary_table()
+        if not TableHandler.table_exist(name):
+            return
+        columns = self.get_columns()
+        for i in self.get_encoded_columns():
+            values = {
+                'table': table,
+                'dictionary': name,
+                'column': columns[i],
+                }
+            if backend.name() == 'postgresql':
+                query = ('UPDATE %(table)s SET "%(column)s" = d.value '
+                    'FROM %(dictionary)s AS d '
+                    'WHERE %(table)s."%(column)s" = d.code' % values)
+            else:
+                query = ('UPDATE %(table)s SET "%(column)s" = ('
+                    'SELECT d.value FROM %(dictionary)s AS d '
+                    'WHERE d.code = %(table)s."%(column)s") '
+                    'WHERE "%(column)s" IN (SELECT code FROM %(dictionary)s)'
+                    % values)
+            cursor.execute(query)
+        cursor.execute('DROP TABLE %s' % name)
+
+    def evaluate_records(self, chunks, checker):
+        """
+        Yields each record of chunks that matches the python filter with the
+        list of values of its expressions
+        """
+        logger = logging.getLogger()
+        model = self.report.model.model
+        start = datetime.today()
+        expressions = self.get_expressions()
+        Model = Pool().get(model)
+        related = [related_field(Model, x[1]) for x in expressions]
+        evaluator = RowEvaluator([(x[1], x[3]) for x in expressions],
+            self.get_python_filter(), related,
+            config.getint('babi', 'cache_size', default=1000))
+        prefetcher = self.get_prefetcher()
+
+        processed = 0
+        for records in chunks:
+            checker.check()
+            logger.info('Calculated %s,  %s records in %s seconds'
+                % (model, processed, datetime.today() - start))
+            if prefetcher:
+                records = prefetcher.records([r.id for r in records])
+            for record in records:
+                values = evaluator(record)
+                if values is None:
+                    continue
+                yield record, values
+            processed += len(records)
+
+        for i, name, cache in evaluator.caches:
+            self.add_log(u'Expression "%s" memoized by %s: %s hits, %s '
+                'misses' % (expressions[i][0], name, cache.hits,
+                    cache.misses))
+
+    def insert_rows(self, table, names, rows):
+        """
+        Saves rows into the columns names of table.
+
+        The first column must be create_date, with 'now()' as value to use the
+        current timestamp.
+        """
+        cursor = Transaction().connection.cursor()
+        if hasattr(cursor, 'copy_from'):
+            # Some older versions of psycopg do not allow column names
+            # to be of type unicode
+            columns = [str('"%s"' % x) for x in names]
+            rows = iter(rows)
+            while True:
+                # Rows may be computed by queries, which can not be run on
+                # the connection while COPY is running, so each batch is
+                # computed before its COPY starts
+                batch = list(islice(rows, COPY_ROWS))
+                if not batch:
+                    break
+                cursor.copy_from(CopyReader(batch), table, columns=columns)
+        else:
+            target = Table(table)
+            target_columns = [Column(target, x) for x in names]
+            # SQLite does not accept more than 999 parameters per query
+            batch_size = max(1, 999 // len(names))
+            batch = []
+            for vals in rows:
+                batch.append([CurrentTimestamp() if vals[0] == 'now()'
+                        else vals[0]]
+                    + [insert_value(x) for x in vals[1:]])
+                if len(batch) >= batch_size:
+                    cursor.execute(*target.insert(target_columns, batch))
+                    batch = []
+            if batch:
+                cursor.execute(*target.insert(target_columns, batch))
+
+    def get_prefetcher(self):
+        """
+        Returns a Prefetcher for the fields used by the expressions or None if
+        the records must be loaded with all their fields
+        """
+        Model = Pool().get(self.report.model.model)
+        expressions = [(x[1], x[1]) for x in self.get_expressions()]
+        python_filter = self.get_python_filter()
+        if python_filter:
+            expressions.append(('python filter', python_filter))
+        paths = set()
+        for name, expression in expressions:
+            expression_paths = attribute_paths(expression)
+            if expression_paths is None:
+                self.add_log(u'Prefetch disabled by expression: %s' % name)
+                return
+            paths |= expression_paths
+        try:
+            prefetcher = Prefetcher(Model, paths)
+        except UnsupportedExpression:
+            self.add_log(u'Prefetch disabled by fields: %s' % ', '.join(
+                    sorted('.'.join(x) for x in paths)))
+            return
+        self.add_log(u'Prefetching fields: %s' % ', '.join(
+                sorted('.'.join(x) for x in paths)))
+        return prefetcher
+
+    def create_parallel_data(self, Model, domain, table, workers, checker,
+            source=False):
+        """
+        Evaluates the records in domain with a pool of worker processes.
+
+        The ids are split in ranges and each range is evaluated by a worker in
+        its own transaction, which saves it into a staging table. Staging
+        tables are then copied into table in the current transaction, so
+        nothing of the execution is committed until it is calculated.
+        """
+        pool = Pool()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        # Tables created by the current transaction are not visible to the
+        # workers but the table of the execution is committed by
+        # validate_model
+        template = pool.get(self.babi_model.model)._table
+
+        with transaction.set_context(_datetime=None):
+            query, params = tuple(Model.search(domain, query=True))
+        # Use more ranges than workers to balance the load between them
+        cursor.execute('SELECT MIN(id), MAX(id) FROM ('
+                'SELECT id, NTILE(%s) OVER (ORDER BY id) AS tile '
+                'FROM (' + query + ') AS a'
+            ') AS b GROUP BY tile ORDER BY 1', (workers * 4,) + tuple(params))
+        args = [(self.id, domain, min_id, max_id,
+                '%s_%d' % (self.get_staging_prefix(), i), template, source)
+            for i, (min_id, max_id) in enumerate(cursor.fetchall())]
+        self.add_log('Evaluating %s ranges of records with %s processes'
+            % (len(args), workers))
+
+        process_pool = multiprocessing.Pool(workers, initializer=init_worker)
+        try:
+            result = process_pool.map_async(create_data_range, args)
+            while not result.ready():
+                checker.check()
+                result.wait(1)
+            result.get()
+        except:
+            process_pool.terminate()
+            raise
+        else:
+            process_pool.close()
+        finally:
+            process_pool.join()
+
+        self.merge_staging(table, [x[4] for x in args], source)
+
+    def create_staging_data(self, domain, min_id, max_id, staging, template,
+            source=False):
+        """
+        Evaluates the records in domain with ids between min_id and max_id and
+        saves them into staging, a new table with the columns of template
+        """
+        Model = Pool().get(self.report.model.model)
+        cursor = Transaction().connection.cursor()
+        # Staging tables are dropped once merged, so they need no WAL
+        cursor.execute('CREATE %s TABLE %s AS SELECT %s FROM %s WHERE 1 = 0'
+            % ('UNLOGGED' if backend.name() == 'postgresql' else '', staging,
+                ','.join('"%s"' % x for x in self.get_columns()), template))
+        if source:
+            cursor.execute('ALTER TABLE %s ADD COLUMN babi_source INTEGER'
+                % staging)
+        domain = [domain, ('id', '>=', min_id), ('id', '<=', max_id)]
+        checker = TimeoutChecker(self.timeout, self.timeout_exception)
+        self.create_python_data(self.search_records(Model, domain, 2000),
+            staging, checker, source)
+
+    def merge_staging(self, table, stagings, source=False):
+        "Copies the rows of the staging tables into table and drops them"
+        cursor = Transaction().connection.cursor()
+        columns = self.get_columns()
+        if source:
+            columns.append('babi_source')
+        columns = ','.join('"%s"' % x for x in columns)
+        for staging in stagings:
+            cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s'
+                % (table, columns, columns, staging))
+            cursor.execute('DROP TABLE %s' % staging)
+
+    def get_staging_prefix(self):
+        "Returns the prefix of the staging tables of the worker processes"
+        return '%s_staging' % self.internal_name
+
+    def get_staging_tables(self):
+        "Returns the staging tables left by the worker processes"
+        if backend.name() != 'postgresql':
+            return []
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT relname FROM pg_class WHERE relkind = %s '
+            'AND relname LIKE %s', ('r',
+                self.get_staging_prefix().replace('_', '\\_') + '\\_%'))
+        return [x for x, in cursor.fetchall()]
+
+    def create_sql_data(self, Model, domain, table, source=False):
+        """
+        Fills table with a single INSERT ... SELECT when all the expressions
+        can be translated into SQL.
+
+        Returns False if records must be evaluated with babi_eval instead.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        columns = self.get_columns()
+        expressions = self.get_expressions()
+
+        try:
+            compiler = ExpressionCompiler(Model)
+        except NotCompilable:
+            compiler = None
+        values = [CurrentTimestamp(), Literal(transaction.user)]
+        for _, expression, ttype, convert_none in expressions:
+            value = None
+            if compiler:
+                try:
+                    value = compiler.compile(expression, ttype, convert_none)
+                except NotCompilable:
+                    pass
+            values.append(value)
+
+        use_sql = (compiler is not None and not self.get_python_filter()
+            and all(v is not None for v in values))
+        for (name, expression, _, _), value in zip(expressions, values[2:]):
+            if use_sql:
+                path = 'SQL'
+            elif value is not None:
+                path = 'Python (translatable to SQL)'
+            else:
+                path = 'Python'
+            self.add_log(u'Expression "%s" (%s): %s' % (name, expression,
+                    path))
+        if self.get_python_filter():
+            self.add_log(u'The python filter must be evaluated with Python')
+        if not use_sql:
+            return False
+
+        if source:
+            columns.append('babi_source')
+            values.append(compiler.table.id)
+        target = Table(table)
+        query = target.insert([Column(target, c) for c in columns],
+            compiler.select(values, domain))
+        cursor.execute(*query)
+        return True
+
+    def limit_dimension_columns(self, tablename):
+        """
+        Replaces by '(others)' the values of the column dimensions with a
+        limit that do not have one of the largest totals of the first measure
+        """
+        cursor = Transaction().connection.cursor()
+        table = Table(tablename)
+        measure = self.report.measures[0]
+        if measure.expression.ttype in ('int', 'float', 'numeric'):
+            total = 'COALESCE(SUM("%s"), 0)' % measure.internal_name
+        else:
+            total = 'COUNT(*)'
         for dimension in self.report.columns:
-            cursor.execute('SELECT %s from %s group by 1 order by 1' % (
-                    dimension.internal_name, tablename))
-            distincts[dimension.id] = [unicode(x[0]) for x in
-                cursor.fetchall()]
-        return distincts
+            if not dimension.limit:
+                continue
+            if dimension.expression.ttype != 'char':
+                self.add_log(u'Limit of column dimension "%s" ignored as it '
+                    'is not a char' % dimension.name)
+                continue
+            cursor.execute('SELECT "%s" FROM %s GROUP BY 1 '
+                'ORDER BY %s DESC, 1 LIMIT %d' % (dimension.internal_name,
+                    tablename, total, dimension.limit))
+            values = [x[0] for x in cursor.fetchall() if x[0] is not None]
+            if not values:
+                continue
+            column = Column(table, dimension.internal_name)
+            # TODO: Make translatable
+            cursor.execute(*table.update([column], ['(others)'],
+                    where=~column.in_(values)))
+            self.add_log(u'Column dimension "%s" limited to %s values' % (
+                    dimension.name, len(values)))
+
+    def check_columns(self, combinations):
+        "Fails if the table would have more columns than configured"
+        Config = Pool().get('babi.configuration')
+        max_columns = Config(1).max_columns
+        columns = (len(self.get_columns()) + len(self.report.measures)
+            * combinations)
+        if max_columns and columns > max_columns:
+            self.raise_user_error('too_many_columns', {
+                    'execution': self.rec_name,
+                    'columns': columns,
+                    'max': max_columns,
+                    })
 
-    def update_internal_measures(self, distincts=None):
+    def distinct_dimension_columns(self, cursor, tablename):
+        """
+        Returns the combinations of values of the column dimensions found in
+        tablename, including the ones with '(all)' in any of them.
+
+        Each combination is a dictionary with the value of each dimension id.
+        """
+        dimensions = sorted(self.report.columns, key=lambda x: x.id)
+        cursor.execute('SELECT DISTINCT %s FROM %s' % (','.join(
+                    '"%s"' % x.internal_name for x in dimensions),
+                tablename))
+        # TODO: Make translatable
+        combinations = set([('(all)',) * len(dimensions)])
+        for row in cursor.fetchall():
+            row = [unicode(x) for x in row]
+            for mask in product((False, True), repeat=len(row)):
+                combinations.add(tuple('(all)' if m else v
+                        for v, m in zip(row, mask)))
+
+        def key(combination):
+            return [(0, '') if x == '(all)' else (2, '') if x == '(others)'
+                else (1, x) for x in combination]
+        return [dict(zip((x.id for x in dimensions), c))
+            for c in sorted(combinations, key=key)]
+
+    def update_internal_measures(self, combinations=None):
+        """
+        Creates the internal measures of the execution, one per measure and
+        combination of column dimension values, as returned by
+        distinct_dimension_columns
+        """
         InternalMeasure = Pool().get('babi.internal.measure')
 
         to_create = []
-        if distincts is None:
-            distincts = {}
-
-        for key in distincts.keys():
-            # TODO: Make translatable
-            distincts[key] = ['(all)'] + sorted(list(distincts[key]))
 
         columns = {}
         for column in self.report.columns:
             columns[column.id] = column
 
         InternalMeasure.delete(self.internal_measures)
+        pivot = {}
         sequence = 0
         for measure in self.report.measures:
             sequence += 1
             related_model_id = None
-            if measure.expression.ttype == 'many2one':
+            ttype = measure.expression.ttype
+            if measure.aggregate == 'distinct':
+                ttype = 'int'
+            elif measure.aggregate == 'median' and ttype == 'int':
+                ttype = 'float'
+            elif ttype == 'many2one':
                 related_model_id = measure.expression.related_model.id
-            if distincts:
-                iterator = DimensionIterator(distincts)
-            else:
-                iterator = [None]
-            for combination in iterator:
+            for combination in combinations or [None]:
                 name = []
                 internal_name = []
                 expression = measure.expression.expression
                 if combination:
-                    for key, index in combination.iteritems():
+                    conditions = []
+                    for key, value in sorted(combination.iteritems()):
                         dimension = columns[key]
-                        value = distincts[key][index]
                         name.append(dimension.name + ' ' + value)
                         internal_name.append(dimension.internal_name + '_' +
                             unaccent(value))
-                        # Zero will always be the '(all)' entry added above
-                        if index > 0:
-                            expression = ('CASE WHEN "%s" = \'%s\' THEN "%s"'
-                                'END') % (dimension.internal_name,
-                                    value, measure.internal_name)
-                        else:
-                            expression = "%s" % (measure.internal_name)
+                        if value != '(all)':
+                            conditions.append('"%s" = \'%s\'' % (
+                                    dimension.internal_name,
+                                    value.replace("'", "''")))
+                    condition = ' AND '.join(conditions) or None
+                    if condition:
+                        expression = 'CASE WHEN %s THEN "%s" END' % (
+                            condition, measure.internal_name)
+                    else:
+                        expression = "%s" % (measure.internal_name)
 
                 name.append(measure.name)
                 internal_name.append(measure.internal_name)
                 name = '/'.join(name)
                 internal_name = '_'.join(internal_name)
+                if combination:
+                    pivot[internal_name] = (measure.internal_name, condition)
                 to_create.append({
                         'execution': self.id,
                         'measure': measure.id,
@@ -1374,11 +2371,61 @@ class ReportExecution(ModelSQL, ModelView):
                         'internal_name': internal_name,
                         'aggregate': measure.aggregate,
                         'expression': expression,
-                        'ttype': measure.expression.ttype,
+                        'ttype': ttype,
                         'related_model': related_model_id,
                         })
         if to_create:
             InternalMeasure.create(to_create)
+        return pivot
+
+    def pivot_data(self, table, columns, pivot):
+        """
+        Copies the rows of table into the table of the execution spreading
+        each measure into the columns of the combinations in pivot.
+
+        pivot maps the internal name of each column to the measure and the
+        condition of its combination, as returned by update_internal_measures.
+        If all the measures can be aggregated twice, rows with the same
+        dimensions are also aggregated, so the pivot is built in one pass.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        BIModel = Pool().get(self.babi_model.model)
+        names = [unicode(x.internal_name) for x in self.internal_measures]
+        if all(x.aggregate in ('sum', 'min', 'max')
+                for x in self.internal_measures):
+            use_filter = getattr(transaction.connection, 'server_version',
+                0) >= 90400
+            dimensions = ['"%s"' % x.internal_name
+                for x in self.report.dimensions]
+            values = []
+            for measure in self.internal_measures:
+                column, condition = pivot[measure.internal_name]
+                if condition is None:
+                    value = '%s("%s")' % (measure.aggregate, column)
+                elif use_filter:
+                    value = '%s("%s") FILTER (WHERE %s)' % (
+                        measure.aggregate, column, condition)
+                else:
+                    value = '%s(%s)' % (measure.aggregate,
+                        measure.expression)
+                values.append(value)
+            query = ('INSERT INTO %s (create_date, create_uid, %s) '
+                'SELECT MAX(create_date), MAX(create_uid), %s FROM %s '
+                'GROUP BY %s') % (BIModel._table,
+                ','.join(dimensions + names), ','.join(dimensions + values),
+                table, ','.join(dimensions))
+        else:
+            query = 'INSERT INTO %s ('
+            query += ','.join([unicode(x) for x in columns])
+            query += ',' + ','.join(names)
+            query += ') SELECT '
+            query += ','.join([unicode(x) for x in columns])
+            query += ',' + ','.join([unicode(x.expression) for x in
+                    self.internal_measures])
+            query += ' FROM %s '
+            query = query % (BIModel._table, table)
+        cursor.execute(query)
 
     def update_measures(self, checker):
         logger = logging.getLogger(self.__name__)
@@ -1388,8 +2435,11 @@ class ReportExecution(ModelSQL, ModelView):
         types_null['char'] = "''"
 
         def query_inserts(table_name, measures, select_group, group,
-                extra=None):
-            """Inserts a group record"""
+                extra=None, source_group=None):
+            """
+            Inserts the group records aggregating the base records or, if
+            source_group is set, the records of that group
+            """
             cursor = Transaction().connection.cursor()
 
             babi_group = ""
@@ -1403,6 +2453,9 @@ class ReportExecution(ModelSQL, ModelView):
 
             select_query = "SELECT %s FROM %s where babi_group IS NULL" % (
                 local_measures, table_name)
+            if source_group:
+                select_query = ("SELECT %s FROM %s where babi_group = '%s'"
+                    % (local_measures, table_name, source_group))
 
             if select_group:
                 select_query += " GROUP BY %s" % select_group
@@ -1435,34 +2488,79 @@ class ReportExecution(ModelSQL, ModelView):
                 cursor.execute(query)
             return [x[0] for x in cursor.fetchall()]
 
-        def update_parent(table_name, parent_id, group, group_by,
-                group_by_types):
-            sql_query = []
+        def level_measures(detail):
+            """
+            Returns the aggregates of the measures computed from the base
+            records if detail, or from the records of the level below
+            otherwise. Averages also keep their sum and count in hidden
+            columns to be rolled up exactly.
+            """
+            measures = []
+            for measure in self.internal_measures:
+                values = {
+                    'name': measure.internal_name,
+                    'aggregate': measure.aggregate,
+                    }
+                if measure.aggregate in SKETCH_AGGREGATES:
+                    # Computed by update_sketches
+                    measures.append('NULL as %(name)s' % values)
+                elif measure.aggregate == 'avg' and detail:
+                    measures += [
+                        'AVG("%(name)s") as %(name)s' % values,
+                        'SUM("%(name)s") as %(name)s__sum' % values,
+                        'COUNT("%(name)s") as %(name)s__count' % values,
+                        ]
+                elif measure.aggregate == 'avg':
+                    measures += [
+                        ('CASE WHEN SUM("%(name)s__count") = 0 THEN NULL '
+                            'ELSE SUM("%(name)s__sum") * 1.0 / '
+                            'SUM("%(name)s__count") END as %(name)s')
+                        % values,
+                        'SUM("%(name)s__sum") as %(name)s__sum' % values,
+                        'SUM("%(name)s__count") as %(name)s__count' % values,
+                        ]
+                elif measure.aggregate == 'count' and not detail:
+                    measures.append('SUM("%(name)s") as %(name)s' % values)
+                else:
+                    measures.append('%(aggregate)s("%(name)s") as %(name)s'
+                        % values)
+            return measures
+
+        def update_parents(table_name, parent_group, group, group_by,
+                group_by_types, parent_id=None):
+            """
+            Links all the records of group to their parent in parent_group
+            (or to parent_id) with a single query
+            """
+            if backend.name() == 'postgresql':
+                child = 'c'
+            else:
+                child = table_name
+            where = []
             for group_item in group_by:
                 values = {
                     'item': group_item,
                     'def': types_null[group_by_types[group_item]],
-                    'table': table_name,
-                    'parent_id': parent_id,
+                    'child': child,
                     }
                 # Values should be coalesce to avoid parent errors when null
-                group_query = ('Coalesce("%(item)s", %(def)s)=(select '
-                    'Coalesce("%(item)s", %(def)s) from %(table)s '
-                    'where id = %(parent_id)d)') % values
-                sql_query.append(group_query)
-
-            sql_query = u' AND '.join(sql_query)
-            sql_query[:-5]
-
-            query = """
-                UPDATE """ + table_name + """ set parent=%s
-                WHERE
-                    parent IS NULL AND
-                    id != %s AND
-                    babi_group = '%s'
-                    """ % (parent_id, parent_id, group)
-            if sql_query:
-                query += 'AND %s' % sql_query
+                where.append('Coalesce(p."%(item)s", %(def)s) = '
+                    'Coalesce(%(child)s."%(item)s", %(def)s)' % values)
+            if parent_id is not None:
+                where.append('p.id = %d' % parent_id)
+            else:
+                where.append("p.babi_group = '%s'" % parent_group)
+            where = ' AND '.join(where)
+
+            if child == 'c':
+                query = ("UPDATE %s AS c SET parent = p.id FROM %s AS p "
+                    "WHERE c.parent IS NULL AND c.babi_group = '%s' AND %s"
+                    % (table_name, table_name, group, where))
+            else:
+                query = ("UPDATE %s SET parent = (SELECT p.id FROM %s AS p "
+                    "WHERE %s LIMIT 1) WHERE parent IS NULL AND "
+                    "babi_group = '%s'" % (table_name, table_name, where,
+                        group))
             cursor.execute(query)
 
         pool = Pool()
@@ -1479,23 +2577,64 @@ class ReportExecution(ModelSQL, ModelView):
         extra_data = ",".join([x.internal_name for x in self.report.dimensions
             if not x.group_by])
 
-        table_name = Pool().get(self.babi_model.model)._table
+        table_name = BIModel._table
         cursor = Transaction().connection.cursor()
 
         group_by_iterator = group_by[:]
 
-        aggregate = None
         current_group = None
+        root_id = None
+
+        if getattr(Transaction().connection, 'server_version', 0) >= 90500:
+            # Build all the levels with a single scan of the rows
+            group = ['"%s"' % x for x in group_by]
+            extra = ['"%s"' % x.internal_name for x in self.report.dimensions
+                if not x.group_by]
+            measures = ['%s("%s") as %s' % (x.aggregate, x.internal_name,
+                    x.internal_name) if x.aggregate not in SKETCH_AGGREGATES
+                else 'NULL as %s' % x.internal_name
+                for x in self.internal_measures]
+            # GROUPING() tells which level each row is the total of
+            babi_group = "CASE %s ELSE '%s' END" % (' '.join(
+                    'WHEN GROUPING(%s) = 1 THEN %s' % (x,
+                        "'%s'" % group_by[i - 1] if i else 'NULL')
+                    for i, x in enumerate(group)), group_by[-1])
+            rollup = group[:-1] + ['(%s)' % ','.join(group[-1:] + extra)]
+            fields = [unaccent(x.internal_name)
+                for x in self.internal_measures] + group + extra
+            query = ('WITH inserted AS (INSERT INTO %s(%s, babi_group) '
+                'SELECT %s, %s FROM %s WHERE babi_group IS NULL '
+                'GROUP BY ROLLUP(%s) RETURNING id, babi_group) '
+                'SELECT id FROM inserted WHERE babi_group IS NULL') % (
+                table_name, ','.join(fields), ','.join(measures + group
+                    + extra), babi_group, table_name, ','.join(rollup))
+            logger.info('Aggregating all levels: %s' % query)
+            cursor.execute(query)
+            root_id, = cursor.fetchone()
+            for level in range(len(group_by) - 1, 0, -1):
+                checker.check()
+                update_parents(table_name, group_by[level - 1],
+                    group_by[level], group_by[:level], group_by_types)
+            child_group = group_by[0]
+            group_by_iterator = []
+
+        # Columns with the sum and count of averages, only needed to build
+        # each level from the level below
+        hidden = []
+        if group_by_iterator:
+            for measure in self.internal_measures:
+                if measure.aggregate == 'avg':
+                    hidden += ['%s__sum' % measure.internal_name,
+                        '%s__count' % measure.internal_name]
+            for name in hidden:
+                cursor.execute('ALTER TABLE %s ADD COLUMN "%s" NUMERIC' % (
+                        table_name, name))
 
         while group_by_iterator:
             checker.check()
 
             group = ['"%s"' % x for x in group_by_iterator]
-            measures = ['%s("%s") as %s' % (
-                        x.aggregate == 'count' and aggregate or x.aggregate,
-                        x.internal_name,
-                        x.internal_name,
-                        ) for x in self.internal_measures] + group
+            measures = level_measures(current_group is None) + group
             measures = ','.join(measures)
             group = ','.join(group)
 
@@ -1504,35 +2643,162 @@ class ReportExecution(ModelSQL, ModelView):
 
             child_group = current_group
             current_group = group_by[len(group_by_iterator) - 1]
-            parent_ids = query_inserts(table_name, measures, group,
-                current_group, extra_data)
+            query_inserts(table_name, measures, group,
+                current_group, extra_data, child_group)
 
             if group_by != group_by_iterator:
-                for parent_id in parent_ids:
-                    update_parent(table_name, parent_id, child_group,
-                        group_by_iterator, group_by_types)
+                update_parents(table_name, current_group, child_group,
+                    group_by_iterator, group_by_types)
 
             child_group = current_group
             group_by_iterator.pop()
             extra_data = None
 
         # ROOT
-        measures = ",".join(['%s("%s") as %s' % (
-                    x.aggregate == 'count' and aggregate or x.aggregate,
-                    x.internal_name, x.internal_name) for x in
-                    self.internal_measures])
-        group = None
-        parent_id = query_inserts(table_name, measures, None, None)[0]
+        if root_id is None:
+            measures = ",".join(level_measures(False))
+            group = None
+            root_id = query_inserts(table_name, measures, None, None,
+                source_group=child_group)[0]
+        parent_id = root_id
         # TODO: Translate '(all)'
         if group_by_types[group_by[0]] != 'many2one':
             cursor.execute("UPDATE " + table_name + " SET \"" + group_by[0] +
                 "\"='" + '(all)' + "' WHERE id=%s" % parent_id)
-        update_parent(table_name, parent_id, child_group, group_by_iterator,
-            group_by_types)
+        update_parents(table_name, None, child_group, group_by_iterator,
+            group_by_types, parent_id)
+        self.update_sketches(table_name, parent_id)
         delete = 'DELETE FROM %s WHERE babi_group IS NULL' % (table_name)
         cursor.execute(delete + ' and id != %s ' % parent_id)
+        # SQLite can not drop columns
+        if backend.name() == 'postgresql':
+            for name in hidden:
+                cursor.execute('ALTER TABLE %s DROP COLUMN "%s"' % (
+                        table_name, name))
         # Update parent_left, parent_right
-        BIModel._rebuild_tree('parent', None, 0)
+        self.update_tree(table_name)
+
+    def create_indexes(self):
+        """
+        Creates the indexes used by the views, the tree searches and the
+        ordering of the execution once its table is loaded
+        """
+        cursor = Transaction().connection.cursor()
+        table = Pool().get(self.babi_model.model)._table
+        dimensions = set(x.internal_name for x in self.report.dimensions)
+        order = []
+        for name, _ in self.get_orders():
+            if name not in order:
+                order.append(name)
+        indexes = [
+            ('babi_group', ['babi_group']),
+            ('parent_left', ['parent_left']),
+            ('parent_right', ['parent_right']),
+            # Children are read by parent and sorted by the report order
+            ('parent_order', ['parent'] + order[:31]),
+            ]
+        indexes += [(x, [x]) for x in order if x in dimensions]
+        for name, columns in indexes:
+            cursor.execute('CREATE INDEX "%s_babi_%s" ON %s (%s)' % (table,
+                    name, table, ','.join('"%s"' % x for x in columns)))
+
+    def update_tree(self, table_name):
+        "Updates parent_left and parent_right of all the records at once"
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT id, parent FROM %s ORDER BY id' % table_name)
+        self.bulk_update(table_name, ['parent_left', 'parent_right'],
+            tree_bounds(cursor.fetchall()))
+
+    def update_sketches(self, table_name, root_id):
+        """
+        Computes the sketches of the approximate measures of each group from
+        the base records, merging them up to root_id, and saves them with
+        their estimates
+        """
+        measures = [x for x in self.internal_measures
+            if x.aggregate in SKETCH_AGGREGATES]
+        if not measures:
+            return
+        cursor = Transaction().connection.cursor()
+        group_by = [x.internal_name for x in self.report.dimensions
+            if x.group_by]
+        dimensions = ','.join('"%s"' % x for x in group_by + [
+                x.internal_name for x in self.report.dimensions
+                if not x.group_by])
+        sketch_columns = ','.join('"%s__sketch"' % x.internal_name
+            for x in measures)
+
+        # Base records are added to the most detailed group they belong to
+        cursor.execute("SELECT %s, id FROM %s WHERE babi_group = '%s'" % (
+                dimensions, table_name, group_by[-1]))
+        leaves = dict((tuple(x[:-1]), x[-1]) for x in cursor.fetchall())
+        sketches = {}
+        cursor.execute('SELECT %s, %s FROM %s WHERE babi_group IS NULL '
+            'AND id != %d' % (dimensions, sketch_columns, table_name,
+                root_id))
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for row in rows:
+                leaf = leaves.get(tuple(row[:-len(measures)]))
+                if leaf not in sketches:
+                    sketches[leaf] = [new_sketch(x.aggregate)
+                        for x in measures]
+                for sketch, value in zip(sketches[leaf],
+                        row[-len(measures):]):
+                    sketch.add(value)
+
+        cursor.execute('SELECT id, parent FROM %s WHERE babi_group IS NOT '
+            'NULL' % table_name)
+        children = defaultdict(list)
+        for id_, parent in cursor.fetchall():
+            children[parent].append(id_)
+        to_update = []
+        # Merge the sketches of the children before their parents
+        stack = [(root_id, False)]
+        while stack:
+            id_, visited = stack.pop()
+            if not visited:
+                stack.append((id_, True))
+                stack.extend((x, False) for x in children[id_])
+                continue
+            if id_ not in sketches:
+                sketches[id_] = [new_sketch(x.aggregate) for x in measures]
+            for child in children[id_]:
+                for sketch, child_sketch in zip(sketches[id_],
+                        sketches.pop(child)):
+                    sketch.merge(child_sketch)
+            estimates = [x.estimate() for x in sketches[id_]]
+            estimates = [Decimal(repr(x)) if isinstance(x, float) else x
+                for x in estimates]
+            to_update.append([id_] + estimates
+                + [x.dumps() for x in sketches[id_]])
+        self.bulk_update(table_name, [x.internal_name for x in measures]
+            + ['%s__sketch' % x.internal_name for x in measures], to_update)
+
+    @staticmethod
+    def bulk_update(table_name, names, rows):
+        """
+        Updates the columns names of table_name with rows, which are lists
+        with the id of the record followed by its values
+        """
+        cursor = Transaction().connection.cursor()
+        if hasattr(cursor, 'copy_from'):
+            values_table = '%s_values' % table_name
+            columns = ','.join('"%s"' % x for x in names)
+            cursor.execute('CREATE TEMP TABLE %s AS SELECT id, %s FROM %s '
+                'WHERE 1 = 0' % (values_table, columns, table_name))
+            cursor.copy_from(CopyReader(rows), values_table)
+            cursor.execute('UPDATE %s SET %s FROM %s AS v WHERE %s.id = v.id'
+                % (table_name, ','.join('"%s" = v."%s"' % (x, x)
+                        for x in names), values_table, table_name))
+            cursor.execute('DROP TABLE %s' % values_table)
+        else:
+            table = Table(table_name)
+            query, _ = table.update([Column(table, x) for x in names],
+                [0] * len(names), where=table.id == 0)
+            cursor.executemany(query, [list(x[1:]) + [x[0]] for x in rows])
 
 
 class OpenExecutionSelect(ModelView):
@@ -1547,7 +2813,7 @@ class OpenExecutionSelect(ModelView):
     execution = fields.Many2One('babi.report.execution', 'Execution',
         required=True, domain=[
             ('report', '=', Eval('report')),
-            ('state', '=', 'calculated'),
+            ('state', 'in', ['calculated', 'archived']),
             ],
         states={
             'readonly': Bool(Eval('execution_readonly')),
@@ -1795,6 +3061,9 @@ class OpenExecution(Wizard):
                 'no_filter_parameter': ('No parameter found for model %s.'
                     'In order to view filtered data, parameter should be'
                     ' defined on the report filter.'),
+                'truncated_execution': ('The data of execution "%s" was '
+                    'lost because its table was unlogged and the database '
+                    'crashed. Calculate the report again.'),
                 })
 
     def __getattribute__(self, name):
@@ -1891,8 +3160,12 @@ class OpenExecution(Wizard):
             execution = self.select.execution
             view_type = self.select.view_type
 
+        if execution and Execution.check_truncated([execution]):
+            self.raise_user_error('truncated_execution', execution.rec_name)
         if not execution:
             self.raise_user_error('no_execution', report.rec_name)
+        if execution.state == 'archived':
+            execution.unarchive()
 
         with transaction.set_context(_datetime=execution.date):
             execution.validate_model()
@@ -2041,6 +3314,10 @@ class DimensionColumn(ModelSQL, ModelView, DimensionMixin):
     "Column Dimension"
     __name__ = 'babi.dimension.column'
     _history = True
+    limit = fields.Integer('Limit', help='Maximum number of values shown '
+        'as columns. Only the values with the largest totals of the first '
+        'measure are kept and the rest are grouped in "(others)". Only used '
+        'by char expressions.')
 
     @classmethod
     def __setup__(cls):
@@ -2196,6 +3473,7 @@ class InternalMeasure(ModelSQL, ModelView):
                 'internal_name': self.internal_name,
                 'expression': self.expression,
                 'ttype': self.ttype,
+                'aggregate': self.aggregate,
                 'related_model': (self.related_model and
                     self.related_model.model),
                 }
@@ -2447,6 +3725,14 @@ class CleanExecutionsStart(ModelView):
     __name__ = 'babi.clean_executions.start'
 
     date = fields.Date('Date', required=True)
+    archive = fields.Boolean('Archive', help='Archive the calculated '
+        'executions instead of deleting them. Archived executions are '
+        'restored when they are opened.')
+
+    @staticmethod
+    def default_archive():
+        Config = Pool().get('babi.configuration')
+        return bool(Config(1).archive_executions)
 
 
 class CleanExecutions(Wizard):
@@ -2462,5 +3748,5 @@ class CleanExecutions(Wizard):
     def transition_clean(self):
         pool = Pool()
         Execution = pool.get('babi.report.execution')
-        Execution.clean(self.start.date)
+        Execution.clean(self.start.date, self.start.archive)
         return 'end'
@@ -0,0 +1,115 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import OrderedDict
+from decimal import Decimal
+
+from .babi_sketch import SKETCHES, new_sketch
+
+__all__ = ['HashAggregator']
+
+
+def _add(aggregate, state, value):
+    "Returns state updated with value, with the semantics of SQL aggregates"
+    if aggregate == 'count':
+        return state + (value is not None)
+    elif aggregate in SKETCHES:
+        state.add(value)
+        return state
+    elif value is None:
+        return state
+    elif aggregate == 'avg':
+        return [state[0] + value, state[1] + 1]
+    elif state is None:
+        return value
+    elif aggregate == 'sum':
+        return state + value
+    elif aggregate == 'min':
+        return min(state, value)
+    elif aggregate == 'max':
+        return max(state, value)
+    raise ValueError(aggregate)
+
+
+def _initial(aggregate):
+    if aggregate == 'count':
+        return 0
+    elif aggregate == 'avg':
+        return [0, 0]
+    elif aggregate in SKETCHES:
+        return new_sketch(aggregate)
+
+
+def _result(aggregate, state):
+    if aggregate == 'avg':
+        total, count = state
+        if not count:
+            return None
+        if isinstance(total, float):
+            return total / count
+        return Decimal(total) / count
+    elif aggregate in SKETCHES:
+        value = state.estimate()
+        if isinstance(value, float):
+            value = Decimal(repr(value))
+        return value
+    return state
+
+
+class HashAggregator(object):
+    """
+    Aggregates rows in memory at every level of a hierarchy of dimensions.
+
+    Each row is the list of the values of the group by dimensions, followed by
+    the values of the extra dimensions (only grouped at the most detailed
+    level) and the values of the measures. aggregates is the list of the
+    aggregate of each measure.
+    """
+
+    def __init__(self, levels, extra, aggregates):
+        self.levels = levels
+        self.dimensions = levels + extra
+        self.aggregates = aggregates
+        self.groups = [OrderedDict() for _ in xrange(levels + 1)]
+        self.groups[0][()] = [_initial(x) for x in aggregates]
+
+    def __len__(self):
+        return sum(len(x) for x in self.groups)
+
+    def add(self, row):
+        dimensions = tuple(row[:self.dimensions])
+        values = row[self.dimensions:]
+        for level, groups in enumerate(self.groups):
+            if level == self.levels:
+                key = dimensions
+            else:
+                key = dimensions[:level]
+            states = groups.get(key)
+            if states is None:
+                states = groups[key] = [_initial(x) for x in self.aggregates]
+            for i, (aggregate, value) in enumerate(zip(self.aggregates,
+                        values)):
+                states[i] = _add(aggregate, states[i], value)
+
+    def parent(self, key):
+        "Returns the key of the parent group of key or None for the root"
+        if not key:
+            return None
+        return key[:min(len(key), self.levels) - 1]
+
+    def rows(self, sketches=False):
+        """
+        Yields the key and the aggregated values of each group, parents
+        before their children.
+
+        If sketches, the values are followed by the serialized sketch of each
+        approximate aggregate.
+        """
+        for groups in self.groups:
+            for key, states in groups.iteritems():
+                values = [_result(a, s)
+                    for a, s in zip(self.aggregates, states)]
+                if sketches:
+                    values += [s.dumps()
+                        for a, s in zip(self.aggregates, states)
+                        if a in SKETCHES]
+                yield key, values
@@ -1,9 +1,12 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from collections import OrderedDict
 from decimal import Decimal
+import ast
 import datetime
 import math
 from dateutil.relativedelta import relativedelta
+from trytond.model import Model
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 
@@ -56,9 +59,10 @@ def date(text):
     return datetime.datetime.strptime(year_month_day(text), '%Y-%m-%d').date()
 
 
-def babi_eval(expression, obj, convert_none='empty'):
-    objects = {
-        'o': obj,
+def babi_namespace():
+    "Returns the names available to expressions"
+    return {
+        'o': None,
         'Pool': Pool,
         'Transaction': Transaction,
         'y': year,
@@ -80,7 +84,10 @@ def babi_eval(expression, obj, convert_none='empty'):
         'Decimal': Decimal,
         'str': str,
         }
-    value = eval(expression, objects)
+
+
+def convert_value(value, convert_none):
+    "Returns the value stored for value"
     if (value is False or value is None):
         if convert_none == 'empty':
             # TODO: Make translatable
@@ -90,3 +97,283 @@ def babi_eval(expression, obj, convert_none='empty'):
         else:
             value = convert_none
     return value
+
+
+def babi_eval(expression, obj, convert_none='empty'):
+    objects = babi_namespace()
+    objects['o'] = obj
+    value = eval(expression, objects)
+    return convert_value(value, convert_none)
+
+
+def parse_expression(expression):
+    "Returns the AST node of expression, which may already be parsed"
+    if isinstance(expression, ast.AST):
+        return expression
+    return ast.parse(expression.strip(), mode='eval').body
+
+
+class RelatedCache(object):
+    """
+    Bounded LRU cache of the values of an expression for each related record.
+
+    code must use "o" as the related record and not the record itself.
+    """
+
+    def __init__(self, code, size):
+        self.code = code
+        self.size = size
+        self.namespace = babi_namespace()
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, related):
+        key = getattr(related, 'id', None)
+        try:
+            value = self.cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            self.namespace['o'] = related
+            value = eval(self.code, self.namespace)
+            if len(self.cache) >= self.size:
+                self.cache.popitem(last=False)
+        self.cache[key] = value
+        return value
+
+
+class _RelatedTransformer(ast.NodeTransformer):
+    "Replaces o.<name> by o"
+
+    def __init__(self, name):
+        self.name = name
+
+    def visit_Attribute(self, node):
+        if (node.attr == self.name and isinstance(node.value, ast.Name)
+                and node.value.id == 'o'):
+            return ast.copy_location(ast.Name(id='o', ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+
+class RowEvaluator(object):
+    """
+    Evaluates a list of expressions on a record at once.
+
+    expressions is a list of tuples with the expression and the convert_none
+    value of babi_eval. All of them, and the optional python_filter, are
+    compiled into a single code object evaluated in a reused namespace.
+    Calling the evaluator returns the list of values, or None if the record
+    does not match python_filter. Expressions may also be given as AST nodes.
+
+    related is an optional list with, for each expression, the name of the
+    Many2One field it only depends on (see related_field) or None. The values
+    of those expressions are memoized for each related record in a
+    RelatedCache of cache_size entries.
+    """
+
+    def __init__(self, expressions, python_filter=None, related=None,
+            cache_size=1000):
+        self.namespace = babi_namespace()
+        self.caches = []
+        elts = []
+        for i, (expression, _) in enumerate(expressions):
+            node = parse_expression(expression)
+            name = related[i] if related else None
+            if name:
+                tree = ast.Expression(
+                    body=_RelatedTransformer(name).visit(node))
+                code = compile(ast.fix_missing_locations(tree), '<string>',
+                    'eval')
+                cache = RelatedCache(code, cache_size)
+                self.caches.append((i, name, cache))
+                function = '_memo%s' % i
+                self.namespace[function] = cache
+                node = ast.Call(func=ast.Name(id=function, ctx=ast.Load()),
+                    args=[ast.Attribute(value=ast.Name(id='o',
+                                ctx=ast.Load()), attr=name, ctx=ast.Load())],
+                    keywords=[], starargs=None, kwargs=None)
+            elts.append(node)
+        body = ast.Tuple(elts=elts, ctx=ast.Load())
+        if python_filter:
+            body = ast.IfExp(test=parse_expression(python_filter), body=body,
+                orelse=ast.Name(id='None', ctx=ast.Load()))
+        tree = ast.fix_missing_locations(ast.Expression(body=body))
+        self.code = compile(tree, '<string>', 'eval')
+        self.convert_none = [x for _, x in expressions]
+
+    def __call__(self, record):
+        self.namespace['o'] = record
+        values = eval(self.code, self.namespace)
+        if values is None:
+            return
+        return [x if x is not None and x is not False
+            else convert_value(x, c)
+            for x, c in zip(values, self.convert_none)]
+
+
+class UnsupportedExpression(Exception):
+    pass
+
+
+def _attribute_paths(node, paths):
+    if isinstance(node, ast.Call):
+        value = node.func
+        while isinstance(value, ast.Attribute):
+            value = value.value
+        if (isinstance(node.func, ast.Attribute)
+                and isinstance(value, ast.Name) and value.id == 'o'):
+            # Methods can not be prefetched
+            raise UnsupportedExpression
+    elif isinstance(node, ast.Attribute):
+        path = []
+        value = node
+        while isinstance(value, ast.Attribute):
+            path.insert(0, value.attr)
+            value = value.value
+        if isinstance(value, ast.Name) and value.id == 'o':
+            paths.add(tuple(path))
+            return
+    elif isinstance(node, ast.Name) and node.id == 'o':
+        # The record is used as a whole
+        raise UnsupportedExpression
+    for child in ast.iter_child_nodes(node):
+        _attribute_paths(child, paths)
+
+
+def attribute_paths(expression):
+    """
+    Returns the set of attribute chains of "o" used by expression. For
+    example: set([('party', 'name')]) for "o.party.name"
+
+    Returns None if the record is used in any other way.
+    """
+    paths = set()
+    try:
+        _attribute_paths(parse_expression(expression), paths)
+    except (SyntaxError, UnsupportedExpression):
+        return None
+    return paths
+
+
+def related_field(Model, expression):
+    """
+    Returns the name of the Many2One field of Model whose target is the only
+    record used by expression, for example "party" for "o.party.name". Returns
+    None if expression uses anything else or only the id of the target.
+    """
+    paths = attribute_paths(expression)
+    if not paths:
+        return
+    names = set(x[0] for x in paths)
+    if len(names) != 1 or all(x[1:] in ((), ('id',)) for x in paths):
+        return
+    name, = names
+    field = Model._fields.get(name)
+    if field is None or field._type != 'many2one':
+        return
+    return name
+
+
+class PrefetchedRecord(object):
+    "Holds the values read for a record"
+
+    def __init__(self, model_name, values):
+        self._model_name = model_name
+        self.__dict__.update(values)
+
+    def __str__(self):
+        return '%s,%s' % (self._model_name, self.id)
+
+    def __unicode__(self):
+        return unicode(str(self))
+
+    def _key(self, record):
+        "Returns the model and id of record, prefetched or browsed"
+        if isinstance(record, PrefetchedRecord):
+            return (record._model_name, record.id)
+        if isinstance(record, Model):
+            return (record.__name__, record.id)
+
+    # Compared like browse records so expressions give the same result
+    def __eq__(self, other):
+        key = self._key(other)
+        if key is None:
+            return NotImplemented
+        return (self._model_name, self.id) == key
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((self._model_name, self.id))
+
+
+class Prefetcher(object):
+    """
+    Reads in bulk the fields used by a list of attribute paths of Model.
+
+    Many2One fields followed by other attributes are read recursively and
+    returned as PrefetchedRecord, the others are returned as browsed records.
+    """
+
+    def __init__(self, Model, paths):
+        self.Model = Model
+        self.tree = {}
+        for path in paths:
+            self._add_path(Model, self.tree, path)
+
+    @staticmethod
+    def _add_path(Model, tree, path):
+        pool = Pool()
+        for i, name in enumerate(path):
+            if name == 'id':
+                if i != len(path) - 1:
+                    raise UnsupportedExpression
+                return
+            field = Model._fields.get(name)
+            if field is None or field._type in ('one2many', 'many2many',
+                    'reference'):
+                raise UnsupportedExpression
+            tree = tree.setdefault(name, {})
+            if i == len(path) - 1:
+                return
+            if field._type != 'many2one':
+                raise UnsupportedExpression
+            Model = pool.get(field.model_name)
+
+    def records(self, ids):
+        "Returns the prefetched records for ids keeping their order"
+        with Transaction().set_context(_datetime=None):
+            records = self._read(self.Model, self.tree, ids)
+        return [records[i] for i in ids]
+
+    def _read(self, Model, tree, ids):
+        pool = Pool()
+        if tree:
+            rows = Model.read(ids, tree.keys())
+        else:
+            rows = [{'id': i} for i in ids]
+        related = {}
+        for name, subtree in tree.iteritems():
+            field = Model._fields[name]
+            if field._type != 'many2one':
+                continue
+            Target = pool.get(field.model_name)
+            target_ids = list(set(r[name] for r in rows
+                    if r[name] is not None))
+            if subtree:
+                related[name] = self._read(Target, subtree, target_ids)
+            else:
+                related[name] = dict((r.id, r)
+                    for r in Target.browse(target_ids))
+        records = {}
+        for row in rows:
+            for name, targets in related.iteritems():
+                if row[name] is not None:
+                    row[name] = targets[row[name]]
+            records[row['id']] = PrefetchedRecord(Model.__name__, row)
+        return records
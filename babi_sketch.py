@@ -0,0 +1,183 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Mergeable sketches used by the approximate aggregates of the reports.
+"""
+import base64
+import hashlib
+import json
+import math
+import struct
+
+__all__ = ['HyperLogLog', 'TDigest', 'new_sketch', 'load_sketch']
+
+
+def _hash(value):
+    "Returns a 64 bits hash of value stable between processes"
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = unicode(value).encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(value).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values added.
+
+    With the default precision of 10 bits the standard error is about 3%.
+    Registers are kept in a dictionary while few of them are used, so small
+    groups take little memory.
+    """
+    kind = 'hll'
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = {}
+
+    def add(self, value):
+        if value is None or value == '':
+            return
+        x = _hash(value)
+        index = x >> (64 - self.precision)
+        bits = 64 - self.precision
+        rest = x & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers.get(index, 0):
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for index, rank in other.registers.iteritems():
+            if rank > self.registers.get(index, 0):
+                self.registers[index] = rank
+
+    def estimate(self):
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        zeros = size - len(self.registers)
+        total = zeros + sum(2.0 ** -x for x in self.registers.itervalues())
+        estimate = alpha * size * size / total
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+    def dumps(self):
+        registers = bytearray(self.size)
+        for index, rank in self.registers.iteritems():
+            registers[index] = rank
+        return json.dumps([self.kind, self.precision,
+                base64.b64encode(str(registers))])
+
+    @classmethod
+    def loads(cls, precision, registers):
+        sketch = cls(precision)
+        for index, rank in enumerate(bytearray(base64.b64decode(registers))):
+            if rank:
+                sketch.registers[index] = rank
+        return sketch
+
+
+class TDigest(object):
+    """
+    Estimates quantiles of the values added.
+
+    Values are summarized in centroids whose size is limited by the k1 scale
+    function, so estimates are more accurate near the extremes.
+    """
+    kind = 'tdigest'
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.centroids = []
+        self.buffer = []
+
+    def add(self, value, weight=1):
+        if value is None or value == '':
+            return
+        self.buffer.append((float(value), weight))
+        if len(self.buffer) > 5 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        self.buffer.extend(other.centroids)
+        self.buffer.extend(other.buffer)
+        self._compress()
+
+    def _scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = []
+        total = float(sum(w for _, w in points))
+        centroids = []
+        start = 0
+        mean, weight = points[0]
+        for value, value_weight in points[1:]:
+            if (self._scale(min(1, (start + weight + value_weight) / total))
+                    - self._scale(start / total)) <= 1:
+                weight += value_weight
+                mean += (value - mean) * value_weight / weight
+            else:
+                centroids.append((mean, weight))
+                start += weight
+                mean, weight = value, value_weight
+        centroids.append((mean, weight))
+        self.centroids = centroids
+
+    def quantile(self, q):
+        self._compress()
+        if not self.centroids:
+            return None
+        total = sum(w for _, w in self.centroids)
+        target = q * total
+        cumulative = 0
+        for i, (mean, weight) in enumerate(self.centroids):
+            center = cumulative + weight / 2.0
+            if center >= target:
+                if not i:
+                    return mean
+                previous_mean, previous_weight = self.centroids[i - 1]
+                previous_center = cumulative - previous_weight / 2.0
+                return previous_mean + ((mean - previous_mean)
+                    * (target - previous_center) / (center - previous_center))
+            cumulative += weight
+        return self.centroids[-1][0]
+
+    def estimate(self):
+        return self.quantile(0.5)
+
+    def dumps(self):
+        self._compress()
+        return json.dumps([self.kind, self.compression, self.centroids])
+
+    @classmethod
+    def loads(cls, compression, centroids):
+        sketch = cls(compression)
+        sketch.centroids = [tuple(x) for x in centroids]
+        return sketch
+
+
+# Sketch used by each approximate aggregate
+SKETCHES = {
+    'distinct': HyperLogLog,
+    'median': TDigest,
+    }
+
+
+def new_sketch(aggregate):
+    "Returns an empty sketch for aggregate"
+    return SKETCHES[aggregate]()
+
+
+def load_sketch(text):
+    "Returns the sketch saved as text by its dumps method"
+    kind, parameter, data = json.loads(text)
+    for Sketch in SKETCHES.itervalues():
+        if Sketch.kind == kind:
+            return Sketch.loads(parameter, data)
+    raise ValueError(kind)
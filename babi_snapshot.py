@@ -0,0 +1,120 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Compressed columnar snapshots of the tables of report executions.
+
+A snapshot is a zlib stream of JSON lines: the first one has the names of
+the columns and each of the next ones a batch of rows stored column by
+column, which keeps together the repeated values of each dimension and
+compresses much better than rows.
+"""
+import datetime
+import json
+import zlib
+from decimal import Decimal
+
+__all__ = ['dumps', 'loads']
+
+# Functions converting each type of value from and to JSON
+ENCODERS = {
+    'decimal': str,
+    'date': datetime.date.isoformat,
+    'datetime': datetime.datetime.isoformat,
+    }
+DECODERS = {
+    'decimal': Decimal,
+    'date': lambda x: datetime.datetime.strptime(x, '%Y-%m-%d').date(),
+    'datetime': lambda x: datetime.datetime.strptime(x,
+        '%Y-%m-%dT%H:%M:%S.%f' if '.' in x else '%Y-%m-%dT%H:%M:%S'),
+    }
+# Number of compressed bytes decompressed at once by loads
+READ_SIZE = 1 << 16
+
+
+def _kind(values):
+    "Returns the kind of the values of a column"
+    for value in values:
+        if value is None:
+            continue
+        elif isinstance(value, Decimal):
+            return 'decimal'
+        elif isinstance(value, datetime.datetime):
+            return 'datetime'
+        elif isinstance(value, datetime.date):
+            return 'date'
+        return
+
+
+def _encode(rows):
+    "Returns the JSON line with the batch of rows"
+    columns = [list(x) for x in zip(*rows)]
+    kinds = []
+    for i, values in enumerate(columns):
+        kind = _kind(values)
+        if kind:
+            encoder = ENCODERS[kind]
+            columns[i] = [None if x is None else encoder(x) for x in values]
+        kinds.append(kind)
+    return json.dumps({
+            'kinds': kinds,
+            'columns': columns,
+            }, separators=(',', ':')) + '\n'
+
+
+def _decode(line):
+    "Returns the rows of a JSON line created by _encode"
+    batch = json.loads(line)
+    columns = batch['columns']
+    for i, kind in enumerate(batch['kinds']):
+        if kind:
+            decoder = DECODERS[kind]
+            columns[i] = [None if x is None else decoder(x)
+                for x in columns[i]]
+    return zip(*columns)
+
+
+def dumps(names, batches):
+    """
+    Returns the batches of rows with the values of the columns names as a
+    compressed string.
+
+    Only one batch is kept uncompressed at a time.
+    """
+    compressor = zlib.compressobj(6)
+    data = [compressor.compress(json.dumps({'names': names}) + '\n')]
+    for rows in batches:
+        if rows:
+            data.append(compressor.compress(_encode(rows)))
+    data.append(compressor.flush())
+    return ''.join(data)
+
+
+def _lines(data):
+    "Yields the lines of data decompressing it by parts"
+    decompressor = zlib.decompressobj()
+    buffer = ''
+    for i in xrange(0, len(data), READ_SIZE):
+        buffer += decompressor.decompress(data[i:i + READ_SIZE])
+        lines = buffer.split('\n')
+        buffer = lines.pop()
+        for line in lines:
+            yield line
+    buffer += decompressor.flush()
+    if buffer:
+        yield buffer
+
+
+def loads(data):
+    """
+    Returns the column names and an iterator over the rows saved with dumps.
+
+    Rows are decoded by batches while they are iterated.
+    """
+    lines = _lines(data)
+    names = json.loads(next(lines))['names']
+
+    def rows():
+        for line in lines:
+            for row in _decode(line):
+                yield row
+    return names, rows()
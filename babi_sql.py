@@ -0,0 +1,365 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import ast
+
+from sql import Column, Literal, Cast
+from sql.conditionals import Coalesce, NullIf
+from sql.functions import Substring
+from sql.operators import Add, Sub, Mul, Div, Neg, Concat
+
+from trytond.model import fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['NotCompilable', 'ExpressionCompiler', 'translate_filter']
+
+# Kind of value returned by each field type. Field types not listed here
+# (booleans, references, x2many, binaries, ...) can not be translated
+# keeping babi_eval semantics.
+FIELD_KINDS = {
+    'char': 'text',
+    'text': 'text',
+    'selection': 'text',
+    'integer': 'integer',
+    'biginteger': 'integer',
+    'float': 'number',
+    'numeric': 'number',
+    'date': 'date',
+    'datetime': 'datetime',
+    'timestamp': 'datetime',
+    }
+NUMBER_KINDS = ('integer', 'number')
+
+# Kinds accepted by each expression ttype. Ids and timestamps are not
+# accepted as text as their text in Python is not the one of the database.
+TTYPE_KINDS = {
+    'char': ('text', 'date', 'integer'),
+    'int': ('integer', 'id'),
+    'float': NUMBER_KINDS,
+    'numeric': NUMBER_KINDS,
+    'many2one': ('id',),
+    }
+
+BINARY_OPERATORS = {
+    ast.Add: Add,
+    ast.Sub: Sub,
+    ast.Mult: Mul,
+    ast.Div: Div,
+    }
+
+
+def _substring(start, length):
+    def function(column):
+        return Substring(Cast(column, 'VARCHAR'), start, length)
+    return function
+
+
+def _year_month(column):
+    return Concat(Concat(_substring(1, 4)(column), '-'),
+        _substring(6, 2)(column))
+
+# Same slices as the functions of babi_eval
+DATE_FUNCTIONS = {
+    'y': _substring(1, 4),
+    'm': _substring(6, 2),
+    'd': _substring(9, 2),
+    'ym': _year_month,
+    'ymd': _substring(1, 10),
+    }
+
+
+class NotCompilable(Exception):
+    pass
+
+
+class ExpressionCompiler(object):
+    """
+    Translates babi expressions into SQL expressions over the table of Model.
+
+    Only attribute chains over stored fields ("o.party.name"), date functions
+    ("ym(o.invoice_date)") and arithmetic on numbers are supported.
+    NotCompilable is raised for any other expression, which must then be
+    evaluated with babi_eval.
+    """
+
+    def __init__(self, Model):
+        if Model.table_query():
+            raise NotCompilable
+        self.Model = Model
+        self.table = Model.__table__()
+        self.from_ = self.table
+        self.joins = {}
+
+    def compile(self, expression, ttype, convert_none):
+        "Returns the SQL expression for expression with babi_eval semantics"
+        try:
+            node = ast.parse(expression.strip(), mode='eval').body
+        except SyntaxError:
+            raise NotCompilable
+        column, kind = self._compile(node)
+        if kind not in TTYPE_KINDS.get(ttype, ()):
+            raise NotCompilable
+        if ttype == 'char':
+            column = Cast(column, 'VARCHAR')
+            if convert_none == 'empty':
+                # TODO: Make translatable
+                column = Coalesce(column, '(empty)')
+            elif convert_none == 'zero':
+                column = Coalesce(column, '0')
+            # Empty strings are stored as NULL by babi_eval results
+            column = NullIf(column, '')
+        elif convert_none == 'zero':
+            column = Coalesce(column, 0)
+        return column
+
+    def select(self, columns, domain):
+        "Returns the query selecting columns for the records in domain"
+        with Transaction().set_context(_datetime=None):
+            query = self.Model.search(domain, query=True)
+        return self.from_.select(*columns,
+            where=self.table.id.in_(query))
+
+    def _compile(self, node):
+        if isinstance(node, ast.Attribute):
+            return self._compile_path(self._path(node))
+        elif isinstance(node, ast.Num):
+            if isinstance(node.n, (int, long)):
+                return Literal(node.n), 'integer'
+            return Literal(node.n), 'number'
+        elif isinstance(node, ast.Str):
+            return Literal(node.s), 'text'
+        elif (isinstance(node, ast.UnaryOp)
+                and isinstance(node.op, ast.USub)):
+            operand, kind = self._compile(node.operand)
+            if kind not in NUMBER_KINDS:
+                raise NotCompilable
+            return Neg(operand), kind
+        elif (isinstance(node, ast.BinOp)
+                and type(node.op) in BINARY_OPERATORS):
+            left, left_kind = self._compile(node.left)
+            right, right_kind = self._compile(node.right)
+            if (left_kind not in NUMBER_KINDS
+                    or right_kind not in NUMBER_KINDS):
+                raise NotCompilable
+            kind = 'number'
+            if left_kind == right_kind == 'integer':
+                # Integer division rounds differently on Python and SQL
+                if isinstance(node.op, ast.Div):
+                    raise NotCompilable
+                kind = 'integer'
+            return BINARY_OPERATORS[type(node.op)](left, right), kind
+        elif (isinstance(node, ast.Call)
+                and isinstance(node.func, ast.Name)
+                and node.func.id in DATE_FUNCTIONS
+                and len(node.args) == 1
+                and not (node.keywords or node.starargs or node.kwargs)):
+            argument, kind = self._compile(node.args[0])
+            if kind not in ('date', 'datetime'):
+                raise NotCompilable
+            return DATE_FUNCTIONS[node.func.id](argument), 'text'
+        raise NotCompilable
+
+    @staticmethod
+    def _path(node):
+        "Returns the list of attributes of an o.x.y chain"
+        path = []
+        while isinstance(node, ast.Attribute):
+            path.insert(0, node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name) or node.id != 'o':
+            raise NotCompilable
+        return path
+
+    def _compile_path(self, path):
+        pool = Pool()
+        Model = self.Model
+        table = self.table
+        for i, name in enumerate(path):
+            last = (i == len(path) - 1)
+            if name == 'id':
+                if not last:
+                    raise NotCompilable
+                return table.id, 'id'
+            field = Model._fields.get(name)
+            if (field is None or isinstance(field, fields.Function)
+                    or getattr(field, 'translate', False)):
+                raise NotCompilable
+            if field._type == 'many2one':
+                if last or path[i + 1:] == ['id']:
+                    return Column(table, name), 'id'
+                Model = pool.get(field.model_name)
+                table = self._join(tuple(path[:i + 1]), table, name, Model)
+                continue
+            if not last or field._type not in FIELD_KINDS:
+                raise NotCompilable
+            return Column(table, name), FIELD_KINDS[field._type]
+        raise NotCompilable
+
+    def _join(self, key, table, name, Target):
+        if key in self.joins:
+            return self.joins[key]
+        if Target.table_query():
+            raise NotCompilable
+        target = Target.__table__()
+        self.from_ = self.from_.join(target, 'LEFT',
+            condition=target.id == Column(table, name))
+        self.joins[key] = target
+        return target
+
+
+DOMAIN_OPERATORS = {
+    ast.Eq: '=',
+    ast.NotEq: '!=',
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+    ast.In: 'in',
+    ast.NotIn: 'not in',
+    }
+# Operator to use when operands are swapped
+SWAPPED_OPERATORS = {
+    '=': '=',
+    '!=': '!=',
+    '<': '>',
+    '<=': '>=',
+    '>': '<',
+    '>=': '<=',
+    }
+# None is lower than any value and different from all of them in Python
+NULL_OPERATORS = ('!=', '<', '<=', 'not in')
+# Operators comparing the order of values, only translated for numbers as
+# the database sorts texts with its collation instead of by code point
+ORDER_OPERATORS = ('<', '<=', '>', '>=')
+# Constant types comparable with each field type
+DOMAIN_KINDS = {
+    'char': 'text',
+    'text': 'text',
+    'selection': 'text',
+    'integer': 'number',
+    'biginteger': 'number',
+    'float': 'number',
+    'numeric': 'number',
+    'boolean': 'boolean',
+    }
+
+
+def _constant(node):
+    "Returns the kind and the value of a constant node"
+    if isinstance(node, ast.Str):
+        return 'text', node.s
+    elif isinstance(node, ast.Num):
+        return 'number', node.n
+    elif isinstance(node, ast.Name) and node.id in ('True', 'False'):
+        return 'boolean', node.id == 'True'
+    elif isinstance(node, ast.Name) and node.id == 'None':
+        return None, None
+    elif isinstance(node, (ast.List, ast.Tuple)):
+        kinds = set()
+        values = []
+        for element in node.elts:
+            kind, value = _constant(element)
+            if kind not in ('text', 'number'):
+                raise NotCompilable
+            kinds.add(kind)
+            values.append(value)
+        if len(kinds) > 1:
+            raise NotCompilable
+        return 'list_' + (kinds.pop() if kinds else 'empty'), values
+    raise NotCompilable
+
+
+def _domain_path(Model, node):
+    "Returns the domain field name and its kind for an o.x.y chain"
+    pool = Pool()
+    path = ExpressionCompiler._path(node)
+    for i, name in enumerate(path):
+        last = (i == len(path) - 1)
+        field = Model._fields.get(name)
+        if (field is None or isinstance(field, fields.Function)
+                or getattr(field, 'translate', False)):
+            raise NotCompilable
+        if field._type == 'many2one':
+            if last:
+                return '.'.join(path), 'record'
+            elif path[i + 1:] == ['id']:
+                return '.'.join(path[:-1]), 'number'
+            Model = pool.get(field.model_name)
+            continue
+        if not last or field._type not in DOMAIN_KINDS:
+            raise NotCompilable
+        return '.'.join(path), DOMAIN_KINDS[field._type]
+    raise NotCompilable
+
+
+def _domain(Model, node):
+    if isinstance(node, ast.BoolOp):
+        clauses = [_domain(Model, x) for x in node.values]
+        if isinstance(node.op, ast.Or):
+            return ['OR'] + clauses
+        return clauses
+    elif isinstance(node, ast.Attribute):
+        name, kind = _domain_path(Model, node)
+        if kind != 'boolean':
+            raise NotCompilable
+        return (name, '=', True)
+    elif (isinstance(node, ast.Compare) and len(node.ops) == 1
+            and type(node.ops[0]) in DOMAIN_OPERATORS):
+        operator = DOMAIN_OPERATORS[type(node.ops[0])]
+        left, right = node.left, node.comparators[0]
+        if not isinstance(left, ast.Attribute):
+            if operator not in SWAPPED_OPERATORS:
+                raise NotCompilable
+            left, right = right, left
+            operator = SWAPPED_OPERATORS[operator]
+        name, kind = _domain_path(Model, left)
+        if operator in ORDER_OPERATORS and kind != 'number':
+            raise NotCompilable
+        value_kind, value = _constant(right)
+        if operator in ('in', 'not in'):
+            if value_kind not in ('list_' + kind, 'list_empty'):
+                raise NotCompilable
+        elif value_kind is None:
+            if operator not in ('=', '!='):
+                raise NotCompilable
+            return (name, operator, None)
+        elif value_kind != kind:
+            raise NotCompilable
+        clause = (name, operator, value)
+        if operator in NULL_OPERATORS:
+            clause = ['OR', clause, (name, '=', None)]
+        return clause
+    raise NotCompilable
+
+
+def translate_filter(Model, expression):
+    """
+    Translates the conditions of a python filter expression into a domain.
+
+    Conditions are the operands of the top level "and" of expression. Returns
+    the domain with the translated conditions, the AST node of the conditions
+    that could not be translated (None if all of them were) and the number of
+    conditions.
+    """
+    try:
+        node = ast.parse(expression.strip(), mode='eval').body
+    except SyntaxError:
+        return [], expression, 1
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        conditions = node.values
+    else:
+        conditions = [node]
+    domain = []
+    remainder = []
+    for condition in conditions:
+        try:
+            domain.append(_domain(Model, condition))
+        except NotCompilable:
+            remainder.append(condition)
+    if not remainder:
+        remainder = None
+    elif len(remainder) == 1:
+        remainder, = remainder
+    else:
+        remainder = ast.BoolOp(op=ast.And(), values=remainder)
+    return domain, remainder, len(conditions)
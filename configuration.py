@@ -10,3 +10,32 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
     __name__ = 'babi.configuration'
 
     default_timeout = fields.Integer('Timeout (s)')
+    workers = fields.Integer('Workers', help='Number of processes used to '
+        'evaluate the records of a report execution. Only used on '
+        'PostgreSQL.')
+    max_columns = fields.Integer('Maximum Columns', help='Executions that '
+        'would need a table with more columns fail. It is checked once the '
+        'records are evaluated, before the columns are created. Leave empty '
+        'for no limit.')
+    live_executions = fields.Integer('Executions in Database',
+        help='Number of the last calculated executions of each report whose '
+        'data is kept in the database. The older ones are archived: their '
+        'data is saved as a compressed snapshot in the data directory, their '
+        'models are removed and they are restored when opened. Leave empty '
+        'to keep all of them in the database.')
+    archive_executions = fields.Boolean('Archive Executions', help='Clean '
+        'archives the calculated executions older than the retention days '
+        'instead of deleting them. Their data is saved as a compressed '
+        'snapshot in the data directory and restored when they are opened.')
+    unlogged = fields.Boolean('Unlogged Tables', help='Create the tables '
+        'of the executions without writing them to the write-ahead log. '
+        'Faster, but their data is lost if the database crashes and they '
+        'must be calculated again. Only used on PostgreSQL 9.5 or later.')
+
+    @staticmethod
+    def default_workers():
+        return 1
+
+    @staticmethod
+    def default_max_columns():
+        return 1000
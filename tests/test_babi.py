@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import ast
 import datetime
 import random
+import time
 import unittest
+from collections import defaultdict
 from decimal import Decimal
 
 from trytond.pool import Pool
@@ -11,7 +14,16 @@ import trytond.tests.test_tryton
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
-from trytond.modules.babi.babi_eval import babi_eval
+from trytond.modules.babi.babi_eval import babi_eval, PrefetchedRecord, \
+    RowEvaluator
+from trytond.modules.babi.babi import tree_bounds, copy_value, \
+    CopyReader, TimeoutChecker, measure_value
+from trytond.modules.babi.babi_aggregate import HashAggregator
+from trytond.modules.babi.babi_sql import ExpressionCompiler, NotCompilable, \
+    translate_filter
+from trytond.modules.babi.babi_sketch import HyperLogLog, TDigest, \
+    load_sketch
+from trytond.modules.babi import babi_snapshot
 from trytond.pyson import PYSONEncoder
 from dateutil.relativedelta import relativedelta
 
@@ -603,6 +615,677 @@ class BaBITestCase(ModuleTestCase):
         for key, value in even_amount.iteritems():
             self.assertEqual(getattr(even, key), value)
 
+    @with_transaction()
+    def test_column_limit(self):
+        'Test the limit of column dimensions and the maximum of columns'
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Menu = pool.get('ir.ui.menu')
+        Report = pool.get('babi.report')
+        Expression = pool.get('babi.expression')
+        Dimension = pool.get('babi.dimension')
+        Column = pool.get('babi.dimension.column')
+        Measure = pool.get('babi.measure')
+        Config = pool.get('babi.configuration')
+        TestModel = pool.get('babi.test')
+        model, = Model.search([('model', '=', 'babi.test')])
+        menu, = Menu.search([('name', '=', 'Business Intelligence')])
+        report, = Report.create([{
+                    'name': 'Limited Column Report',
+                    'model': model.id,
+                    'parent_menu': menu.id,
+                    'timeout': 30,
+                    }])
+        category, = Expression.search([('name', '=', 'Category')])
+        Dimension.create([{
+                    'report': report.id,
+                    'name': 'Category',
+                    'expression': category.id,
+                    }])
+        month, = Expression.search([('name', '=', 'Month')])
+        month, = Column.create([{
+                    'report': report.id,
+                    'name': 'Month',
+                    'expression': month.id,
+                    'limit': 3,
+                    }])
+        amount, = Expression.search([('name', '=', 'Amount')])
+        Measure.create([{
+                    'report': report.id,
+                    'expression': amount.id,
+                    'name': 'Amount',
+                    'aggregate': 'sum',
+                    }])
+        Report.calculate([report])
+        execution = Report(report.id).last_execution
+
+        totals = defaultdict(Decimal)
+        for record in TestModel.search([]):
+            totals['%02d' % record.date.month] += record.amount
+        largest = sorted(totals, key=lambda x: totals[x], reverse=True)[:3]
+        expected = {
+            '(all)': sum(totals.values()),
+            '(others)': sum(v for k, v in totals.iteritems()
+                if k not in largest),
+            }
+        for value in largest:
+            expected[value] = totals[value]
+
+        ReportModel = pool.get(execution.babi_model.model)
+        root, = ReportModel.search([('parent', '=', None)])
+        measures = dict((x.name, x.internal_name)
+            for x in execution.internal_measures)
+        self.assertEqual(sorted(measures), sorted('Month %s/Amount' % x
+                for x in expected))
+        for value, total in expected.iteritems():
+            self.assertEqual(getattr(root, measures['Month %s/Amount'
+                        % value]), total)
+
+        config = Config(1)
+        config.max_columns = 10
+        config.save()
+        Column.write([month], {'limit': None})
+        self.assertRaises(UserError, Report.calculate, [report])
+        config.max_columns = None
+        config.save()
+        Transaction().commit()
+
+    @with_transaction()
+    def test_parallel_data(self):
+        'Test parallel and sequential evaluation give the same rows'
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Menu = pool.get('ir.ui.menu')
+        Report = pool.get('babi.report')
+        Expression = pool.get('babi.expression')
+        Dimension = pool.get('babi.dimension')
+        Measure = pool.get('babi.measure')
+        TestModel = pool.get('babi.test')
+        cursor = Transaction().connection.cursor()
+        model, = Model.search([('model', '=', 'babi.test')])
+        menu, = Menu.search([('name', '=', 'Business Intelligence')])
+        report, = Report.create([{
+                    'name': 'Parallel Report',
+                    'model': model.id,
+                    'parent_menu': menu.id,
+                    'timeout': 30,
+                    }])
+        category, = Expression.search([('name', '=', 'Category')])
+        Dimension.create([{
+                    'report': report.id,
+                    'name': 'Category',
+                    'expression': category.id,
+                    }])
+        # Not translatable into SQL
+        amount, = Expression.search([('name', '=', 'Amount this month')])
+        Measure.create([{
+                    'report': report.id,
+                    'expression': amount.id,
+                    'name': 'Amount this month',
+                    'aggregate': 'sum',
+                    }])
+        Report.calculate([report])
+        execution, = Report(report.id).executions
+        template = execution.internal_name
+        columns = ','.join('"%s"' % x for x in execution.get_columns())
+        for table in ('babi_test_sequential', 'babi_test_parallel'):
+            cursor.execute('CREATE TABLE %s AS SELECT %s FROM %s WHERE 1 = 0'
+                % (table, columns, template))
+
+        checker = TimeoutChecker(execution.timeout,
+            execution.timeout_exception)
+        execution.create_python_data(
+            execution.search_records(TestModel, [], 2000),
+            'babi_test_sequential', checker)
+        ids = [r.id for r in TestModel.search([], order=[('id', 'ASC')])]
+        half = len(ids) // 2
+        stagings = []
+        for i, (min_id, max_id) in enumerate([(ids[0], ids[half - 1]),
+                    (ids[half], ids[-1])]):
+            staging = '%s_%d' % (execution.get_staging_prefix(), i)
+            execution.create_staging_data([], min_id, max_id, staging,
+                template)
+            stagings.append(staging)
+        execution.merge_staging('babi_test_parallel', stagings)
+
+        rows = []
+        for table in ('babi_test_sequential', 'babi_test_parallel'):
+            values = ','.join('"%s"' % x
+                for x in execution.get_columns()[1:])
+            cursor.execute('SELECT %s FROM %s ORDER BY %s'
+                % (values, table, values))
+            rows.append(cursor.fetchall())
+        sequential, parallel = rows
+        self.assertEqual(len(sequential), len(ids))
+        self.assertEqual(sequential, parallel)
+
+    @with_transaction()
+    def test_dictionary_encoding(self):
+        'Test dictionary encoding of char dimensions'
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Menu = pool.get('ir.ui.menu')
+        Report = pool.get('babi.report')
+        Expression = pool.get('babi.expression')
+        Dimension = pool.get('babi.dimension')
+        Measure = pool.get('babi.measure')
+        TestModel = pool.get('babi.test')
+        model, = Model.search([('model', '=', 'babi.test')])
+        menu, = Menu.search([('name', '=', 'Business Intelligence')])
+        report, = Report.create([{
+                    'name': 'Encoded Report',
+                    'model': model.id,
+                    'parent_menu': menu.id,
+                    'timeout': 30,
+                    'dictionary_encoding': True,
+                    }])
+        category, = Expression.search([('name', '=', 'Category')])
+        category, = Dimension.create([{
+                    'report': report.id,
+                    'name': 'Category',
+                    'expression': category.id,
+                    }])
+        # Not translatable into SQL, so records are evaluated in Python
+        amount, = Expression.search([('name', '=', 'Amount this month')])
+        amount, = Measure.create([{
+                    'report': report.id,
+                    'expression': amount.id,
+                    'name': 'Amount this month',
+                    'aggregate': 'sum',
+                    }])
+        Report.calculate([report])
+        execution, = Report(report.id).executions
+        self.assertEqual(execution.get_encoded_columns(), [2])
+        ReportModel = pool.get(execution.babi_model.model)
+
+        # Only disabled when the records are evaluated by workers
+        Report.write([report], {'workers': 2})
+        cursor = Transaction().connection.cursor()
+        self.assertEqual(Report(report.id).last_execution
+            .get_encoded_columns(),
+            [] if hasattr(cursor, 'copy_from') else [2])
+
+        today = datetime.date.today()
+        start = today - relativedelta(days=today.day - 1)
+        amounts = {}
+        for record in TestModel.search([]):
+            amounts.setdefault(record.category, Decimal(0))
+            if record.date >= start:
+                amounts[record.category] += record.amount
+        self.assertEqual(sorted(getattr(x, category.internal_name)
+                for x in ReportModel.search([])), ['(all)', 'even', 'odd'])
+        for value, total in amounts.iteritems():
+            record, = ReportModel.search([
+                    (category.internal_name, '=', value),
+                    ])
+            self.assertEqual(getattr(record, amount.internal_name), total)
+
+    @with_transaction()
+    def test_incremental_report(self):
+        'Test incremental reports give the same values as full ones'
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Menu = pool.get('ir.ui.menu')
+        Report = pool.get('babi.report')
+        Expression = pool.get('babi.expression')
+        Dimension = pool.get('babi.dimension')
+        Measure = pool.get('babi.measure')
+        TestModel = pool.get('babi.test')
+        transaction = Transaction()
+        model, = Model.search([('model', '=', 'babi.test')])
+        menu, = Menu.search([('name', '=', 'Business Intelligence')])
+        category, = Expression.search([('name', '=', 'Category')])
+        amount, = Expression.search([('name', '=', 'Amount')])
+        # Not translatable into SQL
+        amount_this_month, = Expression.search([
+                ('name', '=', 'Amount this month'),
+                ])
+        reports = Report.create([{
+                    'name': 'Incremental Report',
+                    'model': model.id,
+                    'parent_menu': menu.id,
+                    'timeout': 30,
+                    'incremental': True,
+                    }, {
+                    'name': 'Full Report',
+                    'model': model.id,
+                    'parent_menu': menu.id,
+                    'timeout': 30,
+                    }])
+        for report in reports:
+            Dimension.create([{
+                        'report': report.id,
+                        'name': 'Category',
+                        'expression': category.id,
+                        }])
+            Measure.create([{
+                        'report': report.id,
+                        'expression': amount.id,
+                        'name': 'Amount',
+                        'aggregate': 'sum',
+                        }, {
+                        'report': report.id,
+                        'expression': amount_this_month.id,
+                        'name': 'Amount this month',
+                        'aggregate': 'sum',
+                        }])
+        incremental, full = reports
+
+        def values(report):
+            execution = Report(report.id).last_execution
+            ReportModel = pool.get(execution.babi_model.model)
+            names = [x.internal_name for x in execution.report.dimensions
+                + execution.report.measures]
+            return sorted(tuple(getattr(r, x) for x in names)
+                for r in ReportModel.search([]))
+
+        today = datetime.date.today()
+        modified, deleted = TestModel.create([{
+                    'date': today,
+                    'category': 'odd',
+                    'amount': Decimal('10.00'),
+                    }, {
+                    'date': today,
+                    'category': 'even',
+                    'amount': Decimal('20.00'),
+                    }])
+        Report.calculate([incremental])
+        first = Report(incremental.id).last_execution
+        self.assertIn(u'No previous execution', first.log)
+        transaction.commit()
+
+        # Changes must be newer than the execution for any backend precision
+        time.sleep(1)
+        TestModel.write([modified], {
+                'category': 'new',
+                'amount': Decimal('30.00'),
+                })
+        TestModel.delete([deleted])
+        created, = TestModel.create([{
+                    'date': today,
+                    'category': 'odd',
+                    'amount': Decimal('40.00'),
+                    }])
+        Report.calculate([incremental, full])
+        second = Report(incremental.id).last_execution
+        self.assertNotEqual(second.id, first.id)
+        self.assertIn(u'Incremental calculation from execution', second.log)
+        self.assertIn(u'1 records removed, 1 records updated', second.log)
+        self.assertEqual(values(incremental), values(full))
+
+        # The detail can not be reused when the report changes
+        Measure.create([{
+                    'report': report.id,
+                    'expression': amount.id,
+                    'name': 'Amount average',
+                    'aggregate': 'avg',
+                    } for report in reports])
+        Report.calculate([incremental, full])
+        third = Report(incremental.id).last_execution
+        self.assertIn(u'No previous execution', third.log)
+        self.assertEqual(values(incremental), values(full))
+
+        TestModel.delete([modified, created])
+        transaction.commit()
+
+    @with_transaction()
+    def test_memory_engine(self):
+        'Test the memory and database engines give the same rows'
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Menu = pool.get('ir.ui.menu')
+        Report = pool.get('babi.report')
+        Expression = pool.get('babi.expression')
+        Dimension = pool.get('babi.dimension')
+        Measure = pool.get('babi.measure')
+        model, = Model.search([('model', '=', 'babi.test')])
+        menu, = Menu.search([('name', '=', 'Business Intelligence')])
+        category, = Expression.search([('name', '=', 'Category')])
+        month, = Expression.search([('name', '=', 'Month')])
+        amount, = Expression.search([('name', '=', 'Amount')])
+        id_, = Expression.search([('name', '=', 'Id')])
+        reports = Report.create([{
+                    'name': '%s Engine Report' % engine,
+                    'model': model.id,
+                    'parent_menu': menu.id,
+                    'timeout': 30,
+                    'engine': engine,
+                    } for engine in ('memory', 'database')])
+        for report in reports:
+            Dimension.create([{
+                        'report': report.id,
+                        'name': 'Category',
+                        'expression': category.id,
+                        }, {
+                        'report': report.id,
+                        'name': 'Month',
+                        'expression': month.id,
+                        }])
+            Measure.create([{
+                        'report': report.id,
+                        'expression': amount.id,
+                        'name': 'Amount',
+                        'aggregate': 'sum',
+                        }, {
+                        'report': report.id,
+                        'expression': amount.id,
+                        'name': 'Maximum',
+                        'aggregate': 'max',
+                        }, {
+                        'report': report.id,
+                        'expression': id_.id,
+                        'name': 'Records',
+                        'aggregate': 'count',
+                        }, {
+                        'report': report.id,
+                        'expression': category.id,
+                        'name': 'Categories',
+                        'aggregate': 'distinct',
+                        }])
+        Report.calculate(reports)
+
+        results = []
+        for report in Report.browse([x.id for x in reports]):
+            ReportModel = pool.get(report.last_execution.babi_model.model)
+            dimensions = [x.internal_name for x in report.dimensions]
+            measures = [x.internal_name for x in report.measures]
+            records = ReportModel.search([])
+            keys = dict((r.id, tuple(getattr(r, x) for x in dimensions))
+                for r in records)
+            result = set()
+            for record in records:
+                self.assertTrue(getattr(record,
+                        '%s__sketch' % report.measures[-1].internal_name))
+                # The tree is compared through the keys of the descendants
+                descendants = tuple(sorted(keys[r.id] for r in records
+                        if record.parent_left < r.parent_left
+                        < record.parent_right))
+                self.assertEqual(record.parent_right - record.parent_left,
+                    2 * len(descendants) + 1)
+                result.add((keys[record.id],
+                        record.parent and keys[record.parent.id],
+                        tuple(getattr(record, x) for x in measures),
+                        descendants))
+            root, = ReportModel.search([('parent', '=', None)])
+            self.assertEqual(getattr(root, dimensions[0]), '(all)')
+            results.append(result)
+        memory, database = results
+        self.assertEqual(memory, database)
+
+    @with_transaction()
+    def test_approximate_measures(self):
+        'Test approximate distinct count and median measures'
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Menu = pool.get('ir.ui.menu')
+        Report = pool.get('babi.report')
+        Expression = pool.get('babi.expression')
+        Dimension = pool.get('babi.dimension')
+        Measure = pool.get('babi.measure')
+        TestModel = pool.get('babi.test')
+        model, = Model.search([('model', '=', 'babi.test')])
+        menu, = Menu.search([('name', '=', 'Business Intelligence')])
+        report, = Report.create([{
+                    'name': 'Approximate Report',
+                    'model': model.id,
+                    'parent_menu': menu.id,
+                    'timeout': 30,
+                    }])
+        category, month = Dimension.create([{
+                    'report': report.id,
+                    'name': 'Category',
+                    'expression': Expression.search([
+                            ('name', '=', 'Category')])[0].id,
+                    }, {
+                    'report': report.id,
+                    'name': 'Month',
+                    'expression': Expression.search([
+                            ('name', '=', 'Month')])[0].id,
+                    }])
+        distinct, median = Measure.create([{
+                    'report': report.id,
+                    'expression': Expression.search([
+                            ('name', '=', 'Id')])[0].id,
+                    'name': 'Records',
+                    'aggregate': 'distinct',
+                    }, {
+                    'report': report.id,
+                    'expression': Expression.search([
+                            ('name', '=', 'Amount')])[0].id,
+                    'name': 'Median',
+                    'aggregate': 'median',
+                    }])
+        Report.calculate([report])
+        execution = Report(report.id).last_execution
+        ReportModel = pool.get(execution.babi_model.model)
+
+        amounts = defaultdict(list)
+        for record in TestModel.search([]):
+            for key in [(), (record.category,),
+                    (record.category, '%02d' % record.date.month)]:
+                amounts[key].append(record.amount)
+
+        root, = ReportModel.search([('parent', '=', None)])
+        groups = {(): root}
+        for record in ReportModel.search([('parent', '=', root.id)]):
+            key = (getattr(record, category.internal_name),)
+            groups[key] = record
+            for child in ReportModel.search([('parent', '=', record.id)]):
+                groups[key + (getattr(child, month.internal_name),)] = child
+        self.assertEqual(sorted(groups), sorted(amounts))
+        for key, values in amounts.iteritems():
+            record = groups[key]
+            self.assertAlmostEqual(getattr(record, distinct.internal_name),
+                len(values), delta=max(1, len(values) * 0.05))
+            # The estimate is close to the middle of the sorted values
+            estimate = getattr(record, median.internal_name)
+            epsilon = Decimal('0.01')
+            self.assertGreaterEqual(
+                len([x for x in values if x <= estimate + epsilon]),
+                len(values) * 0.4)
+            self.assertGreaterEqual(
+                len([x for x in values if x >= estimate - epsilon]),
+                len(values) * 0.4)
+
+    @with_transaction()
+    def test_prefetch(self):
+        'Test reports give the same values with and without prefetch'
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Menu = pool.get('ir.ui.menu')
+        Report = pool.get('babi.report')
+        Expression = pool.get('babi.expression')
+        Dimension = pool.get('babi.dimension')
+        Measure = pool.get('babi.measure')
+        TestModel = pool.get('babi.test')
+        model, = Model.search([('model', '=', 'babi.test')])
+        menu, = Menu.search([('name', '=', 'Business Intelligence')])
+        category, = Expression.search([('name', '=', 'Category')])
+        # Not translatable into SQL
+        amount, = Expression.search([('name', '=', 'Amount this month')])
+        # Uses the record itself, which can not be prefetched
+        record, = Expression.create([{
+                    'name': 'Record',
+                    'model': model.id,
+                    'ttype': 'int',
+                    'expression': '1 if o else 0',
+                    }])
+        reports = Report.create([{
+                    'name': 'Prefetched Report',
+                    'model': model.id,
+                    'parent_menu': menu.id,
+                    'timeout': 30,
+                    }, {
+                    'name': 'Browsed Report',
+                    'model': model.id,
+                    'parent_menu': menu.id,
+                    'timeout': 30,
+                    }])
+        for report in reports:
+            Dimension.create([{
+                        'report': report.id,
+                        'name': 'Category',
+                        'expression': category.id,
+                        }])
+            Measure.create([{
+                        'report': report.id,
+                        'expression': amount.id,
+                        'name': 'Amount this month',
+                        'aggregate': 'sum',
+                        }])
+        Measure.create([{
+                    'report': reports[1].id,
+                    'expression': record.id,
+                    'name': 'Records',
+                    'aggregate': 'sum',
+                    }])
+        Report.calculate(reports)
+
+        results = []
+        for report in Report.browse([x.id for x in reports]):
+            execution = report.last_execution
+            ReportModel = pool.get(execution.babi_model.model)
+            dimension, = report.dimensions
+            measure, = [x for x in report.measures
+                if x.name == 'Amount this month']
+            results.append(sorted((getattr(x, dimension.internal_name),
+                        getattr(x, measure.internal_name))
+                    for x in ReportModel.search([])))
+            results.append(execution.log)
+        prefetched, prefetched_log, browsed, browsed_log = results
+        self.assertIn(u'Prefetching fields', prefetched_log)
+        self.assertIn(u'Prefetch disabled by expression', browsed_log)
+        self.assertEqual(prefetched, browsed)
+
+        records = TestModel.search([], limit=2)
+        first, second = [PrefetchedRecord('babi.test', {'id': x.id})
+            for x in records]
+        self.assertEqual(first, records[0])
+        self.assertEqual(records[0], first)
+        self.assertNotEqual(first, records[1])
+        self.assertNotEqual(first, second)
+        self.assertEqual(hash(first), hash(records[0]))
+        self.assertIn(records[0], set([first]))
+
+    @with_transaction()
+    def test_expression_compiler(self):
+        'Test SQL expressions give the same values as babi_eval'
+        pool = Pool()
+        TestModel = pool.get('babi.test')
+        cursor = Transaction().connection.cursor()
+        records = TestModel.create([{
+                    'category': 'odd',
+                    'date': datetime.date(2015, 3, 4),
+                    'amount': Decimal('-2.50'),
+                    }, {
+                    'category': '',
+                    'date': None,
+                    'amount': Decimal('1234.57'),
+                    }, {
+                    'category': None,
+                    'date': datetime.date(2016, 11, 30),
+                    'amount': Decimal('0'),
+                    }])
+
+        def normalize(value, ttype):
+            if value is None or value == '':
+                return None
+            if ttype == 'char':
+                return unicode(value)
+            elif ttype == 'int':
+                return int(value)
+            if isinstance(value, float):
+                value = Decimal(repr(value))
+            return Decimal(value).quantize(Decimal('0.000001'))
+
+        compiler = ExpressionCompiler(TestModel)
+        for expression, ttype in [
+                ('o.category', 'char'),
+                ("'x'", 'char'),
+                ('o.date', 'char'),
+                ('y(o.date)', 'char'),
+                ('m(o.date)', 'char'),
+                ('d(o.date)', 'char'),
+                ('ym(o.date)', 'char'),
+                ('ymd(o.date)', 'char'),
+                ('o.id', 'int'),
+                ('o.amount', 'numeric'),
+                ('-o.amount', 'numeric'),
+                ('o.amount * 2 + 1', 'numeric'),
+                ('o.amount / 4 - o.amount', 'numeric'),
+                ]:
+            convert_none = 'empty' if ttype == 'char' else 'zero'
+            column = compiler.compile(expression, ttype, convert_none)
+            cursor.execute(*compiler.select([compiler.table.id, column],
+                    [('id', 'in', [r.id for r in records])]))
+            values = dict((id_, normalize(v, ttype))
+                for id_, v in cursor.fetchall())
+            for record in records:
+                self.assertEqual(values[record.id], normalize(
+                        babi_eval(expression, record, convert_none), ttype),
+                    expression)
+
+        for expression, ttype in [
+                ('o.id', 'char'),
+                ('o.amount', 'char'),
+                ('o.id / 2', 'numeric'),
+                ('o.category.upper()', 'char'),
+                ]:
+            self.assertRaises(NotCompilable, compiler.compile, expression,
+                ttype, 'empty')
+
+    @with_transaction()
+    def test_translate_filter(self):
+        'Test translation of python filters into domains'
+        pool = Pool()
+        TestModel = pool.get('babi.test')
+
+        def node(expression):
+            return ast.dump(ast.parse(expression, mode='eval').body)
+
+        domain, remainder, conditions = translate_filter(TestModel,
+            "o.category == 'odd' and o.amount > 10 "
+            "and o.category.upper() == 'X'")
+        self.assertEqual(domain, [
+                ('category', '=', 'odd'),
+                ('amount', '>', 10),
+                ])
+        self.assertEqual(ast.dump(remainder),
+            node("o.category.upper() == 'X'"))
+        self.assertEqual(conditions, 3)
+
+        domain, remainder, conditions = translate_filter(TestModel,
+            "o.date and o.category < 'b' and o.amount >= 1")
+        self.assertEqual(domain, [('amount', '>=', 1)])
+        self.assertEqual(ast.dump(remainder),
+            node("o.date and o.category < 'b'"))
+        self.assertEqual(conditions, 3)
+
+        for expression, result in [
+                ("o.amount > 1 or o.category == 'a'",
+                    ['OR', ('amount', '>', 1), ('category', '=', 'a')]),
+                ("o.category in ['a', 'b']", ('category', 'in', ['a', 'b'])),
+                ('o.category == None', ('category', '=', None)),
+                ('o.amount != 5',
+                    ['OR', ('amount', '!=', 5), ('amount', '=', None)]),
+                ('o.amount < 5',
+                    ['OR', ('amount', '<', 5), ('amount', '=', None)]),
+                ('5 >= o.amount',
+                    ['OR', ('amount', '<=', 5), ('amount', '=', None)]),
+                ("o.category not in ['a']",
+                    ['OR', ('category', 'not in', ['a']),
+                        ('category', '=', None)]),
+                ]:
+            self.assertEqual(translate_filter(TestModel, expression),
+                ([result], None, 1), expression)
+
+        for expression in ["o.category >= 'b'", "'b' < o.category",
+                "o.amount == 'a'", 'o.amount < None']:
+            domain, remainder, conditions = translate_filter(TestModel,
+                expression)
+            self.assertEqual(domain, [], expression)
+            self.assertEqual(ast.dump(remainder), node(expression))
+
     @with_transaction()
     def test_eval(self):
         'Test babi_eval'
@@ -650,6 +1333,139 @@ class BaBITestCase(ModuleTestCase):
         self.assertEqual(babi_eval('o', None, convert_none=''), '')
         self.assertEqual(babi_eval('o', None, convert_none=None), None)
 
+    @with_transaction()
+    def test_row_evaluator(self):
+        'Test RowEvaluator'
+        date = datetime.date(2014, 10, 10)
+        evaluator = RowEvaluator([
+                ('ym(o)', 'empty'),
+                ('None', 'empty'),
+                ('None', 'zero'),
+                ('None', ''),
+                ('o.year', 'zero'),
+                ], 'o.month == 10')
+        self.assertEqual(evaluator(date), ['2014-10', '(empty)', '0', '',
+                2014])
+        self.assertEqual(evaluator(datetime.date(2014, 1, 1)), None)
+        evaluator = RowEvaluator([('o', 'empty')])
+        self.assertEqual(evaluator(None), ['(empty)'])
+
+        party = PrefetchedRecord('party.party', {'id': 1, 'name': 'Name'})
+        evaluator = RowEvaluator([
+                ('o.party.name if o.party else None', 'empty'),
+                ('o.amount', 'zero'),
+                ], related=['party', None], cache_size=1)
+        for amount in (1, 2):
+            line = PrefetchedRecord('line', {'id': amount, 'party': party,
+                    'amount': amount})
+            self.assertEqual(evaluator(line), ['Name', amount])
+        line = PrefetchedRecord('line', {'id': 3, 'party': None,
+                'amount': None})
+        self.assertEqual(evaluator(line), ['(empty)', '0'])
+        (_, _, cache), = evaluator.caches
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_hash_aggregator(self):
+        'Test HashAggregator'
+        aggregator = HashAggregator(2, 1, ['sum', 'count', 'avg', 'max'])
+        for row in [
+                ['a', 'x', 1, 1, 1, 1, 1],
+                ['a', 'x', 2, 2, 2, 2, 2],
+                ['a', 'y', 1, 3, None, 3, 3],
+                ['b', 'x', 1, 4, 4, 4, 4],
+                ]:
+            aggregator.add(row)
+        self.assertEqual(len(aggregator), 7)
+        rows = dict(aggregator.rows())
+        self.assertEqual(rows[()], [10, 3, Decimal('2.5'), 4])
+        self.assertEqual(rows[('a',)], [6, 2, 2, 3])
+        self.assertEqual(rows[('a', 'y', 1)], [3, 0, 3, 3])
+        self.assertEqual(aggregator.parent(('a', 'x', 1)), ('a',))
+        self.assertEqual(aggregator.parent(('a',)), ())
+        self.assertEqual(aggregator.parent(()), None)
+        aggregator = HashAggregator(1, 0, ['sum', 'distinct'])
+        for row in [['a', 1, 'x'], ['a', 2, 'y'], ['b', 3, 'x']]:
+            aggregator.add(row)
+        rows = dict(aggregator.rows(sketches=True))
+        self.assertEqual(rows[()][:2], [6, 2])
+        self.assertEqual(load_sketch(rows[()][2]).estimate(), 2)
+
+    def test_memory_float_measure(self):
+        'Test memory aggregation of float measures with None values'
+        self.assertEqual(measure_value('float', '0'), 0.0)
+        self.assertIsInstance(measure_value('float', '0'), float)
+        self.assertEqual(measure_value('numeric', 1.5), Decimal('1.5'))
+        self.assertEqual(measure_value('int', '0'), 0)
+        self.assertEqual(measure_value('float', None), None)
+        aggregator = HashAggregator(1, 0, ['sum', 'avg'])
+        # The evaluator returns '0' for None measures
+        for value in [1.5, '0', 2.5]:
+            value = measure_value('float', value)
+            aggregator.add(['a', value, value])
+        rows = dict(aggregator.rows())
+        self.assertEqual(rows[('a',)], [4.0, 4.0 / 3])
+        self.assertIsInstance(rows[()][0], float)
+
+    def test_sketches(self):
+        'Test approximate aggregate sketches'
+        first, second = HyperLogLog(), HyperLogLog()
+        for value in range(100):
+            first.add(value)
+            second.add(value + 50)
+        first.merge(second)
+        self.assertEqual(load_sketch(first.dumps()).estimate(),
+            first.estimate())
+        self.assertAlmostEqual(first.estimate(), 150, delta=10)
+
+        digest = TDigest()
+        for value in range(1, 1002):
+            digest.add(value)
+        self.assertAlmostEqual(load_sketch(digest.dumps()).estimate(), 501,
+            delta=5)
+
+    def test_snapshot(self):
+        'Test execution snapshots'
+        names = ['create_date', 'id', 'babi_group', 'amount', 'date']
+        rows = [
+            (datetime.datetime(2016, 1, 2, 3, 4, 5, 6), 1, None,
+                Decimal('1.5'), datetime.date(2016, 1, 2)),
+            (datetime.datetime(2016, 1, 2, 3, 4, 5), 2, u'\xe0', None,
+                None),
+            ]
+        loaded_names, loaded_rows = babi_snapshot.loads(
+            babi_snapshot.dumps(names, [rows[:1], rows[1:], []]))
+        self.assertEqual(loaded_names, names)
+        self.assertEqual(list(loaded_rows), rows)
+        loaded_names, loaded_rows = babi_snapshot.loads(
+            babi_snapshot.dumps(names, []))
+        self.assertEqual(loaded_names, names)
+        self.assertEqual(list(loaded_rows), [])
+
+    def test_copy_reader(self):
+        'Test CopyReader'
+        self.assertEqual(copy_value(None), '\\N')
+        self.assertEqual(copy_value(''), '\\N')
+        self.assertEqual(copy_value('a\tb\\c\nd\re'), 'a\\tb\\\\c\\nd\\re')
+        self.assertEqual(copy_value(u'\xe0'), '\xc3\xa0')
+        self.assertEqual(copy_value(Decimal('1.50')), '1.50')
+        rows = [[1, None, u'a\tb'], [2, 'x', '']]
+        data = '1\t\\N\ta\\tb\n2\tx\t\\N\n'
+        self.assertEqual(CopyReader(rows).read(), data)
+        reader = CopyReader(rows)
+        chunks = []
+        chunk = reader.read(4)
+        while chunk:
+            chunks.append(chunk)
+            chunk = reader.read(4)
+        self.assertEqual(chunks[0], data[:4])
+        self.assertEqual(''.join(chunks), data)
+
+    def test_tree_bounds(self):
+        'Test tree_bounds'
+        self.assertEqual(sorted(tree_bounds([(1, None), (2, 1), (3, 1),
+                        (4, 2), (5, None)])),
+            [(1, 1, 8), (2, 2, 5), (3, 6, 7), (4, 3, 4), (5, 9, 10)])
+
     @with_transaction()
     def test_basic_operations(self):
         'Test basic operations'